@@ -7,12 +7,38 @@
 
 
 import os
+import sys
 import re
+import time
+import io
+import json
+import codecs
+import pickle
+import hashlib
+import mmap
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import socket
+import socketserver
+import threading
+import subprocess
 import argparse
+import bisect
+import contextlib
+import heapq
+import shutil
+import tempfile
 import colorama
 from colorama import Fore, Style
-from fnmatch import fnmatch
+from fnmatch import translate
 from datetime import datetime
+from array import array
+from collections import namedtuple
+from itertools import accumulate, chain, islice
+from concurrent.futures import ProcessPoolExecutor
 
 colorama.init()
 
@@ -25,12 +51,12 @@ YELLOW = Fore.YELLOW
 RESET = Style.RESET_ALL
 
 # 打印错误信息
-def print_error(message, line=None, line_number=None, additional_info=None):
+def print_error(message, line=None, line_number=None, additional_info=None, filename=None):
     """统一打印错误信息的格式"""
     print(f"\n{RED}错误: {RESET}{message}")
 
     if line_number is not None:
-        print(f"{RED}位置: {RESET}config.ini 文件第 {line_number} 行")
+        print(f"{RED}位置: {RESET}{filename or 'config.ini'} 文件第 {line_number} 行")
 
     if line is not None:
         print(f"{RED}内容: {RESET}{line}")
@@ -40,183 +66,262 @@ def print_error(message, line=None, line_number=None, additional_info=None):
 
     print()  # 空行，使错误信息更清晰
 
+# 预处理表达式的记号：整数（可带后缀）、标识符、运算符
+PP_TOKEN = re.compile(r'\s*(?:(0[xX][0-9a-fA-F]+|\d+)[uUlL]*|([A-Za-z_]\w*)|(&&|\|\||==|!=|<=|>=|<<|>>|[-+*/%<>!~&|^()?:]))')
+
+# 二元运算符优先级，数值越大结合越紧
+PP_BINARY_PRECEDENCE = {
+    '||': 1, '&&': 2, '|': 3, '^': 4, '&': 5,
+    '==': 6, '!=': 6, '<': 7, '>': 7, '<=': 7, '>=': 7,
+    '<<': 8, '>>': 8, '+': 9, '-': 9, '*': 10, '/': 10, '%': 10,
+}
+
+# 切分预处理表达式
+def tokenize_preprocessor_expression(expr):
+    """返回记号列表：整数为int，标识符和运算符为str"""
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = PP_TOKEN.match(expr, pos)
+        if not match:
+            raise ValueError(f"无法识别的字符 '{expr[pos:].strip()[:1]}'")
+        number, name, operator = match.groups()
+        if number:
+            # 0x开头为十六进制，其余0开头的为八进制
+            if number[:2] in ('0x', '0X'):
+                tokens.append(int(number, 16))
+            elif len(number) > 1 and number[0] == '0':
+                tokens.append(int(number, 8))
+            else:
+                tokens.append(int(number))
+        else:
+            tokens.append(name or operator)
+        pos = match.end()
+    return tokens
+
+# 展开表达式中的defined和宏
+def expand_preprocessor_tokens(tokens, defined_macros, expanding=frozenset()):
+    """一次遍历完成defined求值和宏替换，宏值递归展开，未定义的标识符按C语义视为0"""
+    expanded = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == 'defined':
+            # 支持 defined X 和 defined(X) 两种写法
+            if i + 1 < len(tokens) and tokens[i + 1] == '(':
+                if i + 3 >= len(tokens) or tokens[i + 3] != ')' or not isinstance(tokens[i + 2], str):
+                    raise ValueError("defined( ) 语法错误")
+                name = tokens[i + 2]
+                i += 4
+            elif i + 1 < len(tokens) and isinstance(tokens[i + 1], str):
+                name = tokens[i + 1]
+                i += 2
+            else:
+                raise ValueError("defined 后缺少宏名")
+            expanded.append(1 if name in defined_macros else 0)
+            continue
+        if isinstance(token, str) and (token[0].isalpha() or token[0] == '_'):
+            if token in defined_macros and token not in expanding:
+                value_tokens = tokenize_preprocessor_expression(defined_macros[token])
+                expanded.append('(')
+                expanded.extend(expand_preprocessor_tokens(value_tokens, defined_macros, expanding | {token}))
+                expanded.append(')')
+            else:
+                expanded.append(0)
+        else:
+            expanded.append(token)
+        i += 1
+    return expanded
+
+# 计算预处理条件表达式
+def evaluate_preprocessor_expression(expr, defined_macros):
+    """支持defined、! ~ - +、算术、移位、比较、位运算、&& || 和 ?:，出错时抛出ValueError"""
+    tokens = expand_preprocessor_tokens(tokenize_preprocessor_expression(expr), defined_macros)
+    if not tokens:
+        raise ValueError("条件表达式为空")
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal pos
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError(f"缺少 '{expected}'" if expected else "表达式不完整")
+        pos += 1
+        return token
+
+    # live为False时处于短路不求值的分支，除零等错误不报告
+    def parse_unary(live):
+        token = take()
+        if isinstance(token, int):
+            return token
+        if token == '(':
+            value = parse_expression(live)
+            take(')')
+            return value
+        if token in ('!', '~', '-', '+'):
+            value = parse_unary(live)
+            return {'!': lambda v: int(not v), '~': lambda v: ~v, '-': lambda v: -v, '+': lambda v: v}[token](value)
+        raise ValueError(f"意外的记号 '{token}'")
+
+    def parse_binary(min_precedence, live):
+        left = parse_unary(live)
+        while True:
+            operator = peek()
+            precedence = PP_BINARY_PRECEDENCE.get(operator) if isinstance(operator, str) else None
+            if precedence is None or precedence < min_precedence:
+                return left
+            take()
+            if operator == '&&':
+                right = parse_binary(precedence + 1, live and bool(left))
+                left = int(bool(left) and bool(right))
+            elif operator == '||':
+                right = parse_binary(precedence + 1, live and not left)
+                left = int(bool(left) or bool(right))
+            else:
+                right = parse_binary(precedence + 1, live)
+                left = apply_binary(operator, left, right, live)
+
+    def apply_binary(operator, left, right, live):
+        if operator in ('/', '%'):
+            if right == 0:
+                if live:
+                    raise ValueError("除数为0")
+                return 0
+            # C语言的整数除法向0取整
+            quotient = abs(left) // abs(right) * (1 if (left < 0) == (right < 0) else -1)
+            return quotient if operator == '/' else left - quotient * right
+        return {
+            '|': lambda: left | right, '^': lambda: left ^ right, '&': lambda: left & right,
+            '==': lambda: int(left == right), '!=': lambda: int(left != right),
+            '<': lambda: int(left < right), '>': lambda: int(left > right),
+            '<=': lambda: int(left <= right), '>=': lambda: int(left >= right),
+            '<<': lambda: left << right, '>>': lambda: left >> right,
+            '+': lambda: left + right, '-': lambda: left - right, '*': lambda: left * right,
+        }[operator]()
+
+    def parse_expression(live):
+        condition = parse_binary(1, live)
+        if peek() != '?':
+            return condition
+        take('?')
+        if_true = parse_expression(live and bool(condition))
+        take(':')
+        if_false = parse_expression(live and not condition)
+        return if_true if condition else if_false
+
+    value = parse_expression(True)
+    if pos != len(tokens):
+        raise ValueError(f"多余的记号 '{tokens[pos]}'")
+    return value
+
+# 计算条件指令的表达式，出错时打印错误并视为False
+def evaluate_condition(expr, defined_macros, line, line_number, filename):
+    try:
+        return bool(evaluate_preprocessor_expression(expr, defined_macros))
+    except ValueError as e:
+        print_error(f"无法计算条件表达式 '{expr}'，默认为False", line, line_number, str(e), filename)
+        return False
+
 # 处理预处理指令
-def parse_config_preprocessor_directive(line, defined_macros, condition_stack, skip_current_level, line_number=None):
-    # 去除#后的前导空格
-    line_content = line[1:].lstrip()
+def parse_config_preprocessor_directive(line, defined_macros, condition_stack, skip_current_level, line_number=None, filename=None):
+    """condition_stack每层记录 [外层是否生效, 本组是否已有分支成立, 当前分支是否生效]"""
+    # 去除#后的前导空格，拆出指令名和参数
+    match = re.match(r'(\w*)\s*(.*)', line[1:].strip())
+    directive = match.group(1)
+    # 参数中的注释不参与求值
+    argument = re.sub(r'/\*.*?\*/', ' ', match.group(2)).split('//')[0].strip()
 
     # 处理#define
-    if line_content.startswith('define '):
+    if directive == 'define':
         if skip_current_level:
             return condition_stack, skip_current_level
-        parts = line_content[7:].strip().split(' ', 1)
+        parts = argument.split(None, 1)
         if len(parts) >= 1:
             macro_name = parts[0]
             macro_value = parts[1] if len(parts) > 1 else "1"
             defined_macros[macro_name] = macro_value
         return condition_stack, skip_current_level
 
-    # 处理#ifdef
-    elif line_content.startswith('ifdef '):
-        macro_name = line_content[6:].strip()
-        is_defined = macro_name in defined_macros
-
-        if condition_stack and not condition_stack[-1]:
-            # 已经在一个false条件内，继续跳过
-            condition_stack.append(False)
-        else:
-            condition_stack.append(is_defined)
-
-        skip_current_level = not condition_stack[-1]
-        return condition_stack, skip_current_level
-
-    # 处理#ifndef
-    elif line_content.startswith('ifndef '):
-        macro_name = line_content[7:].strip()
-        is_not_defined = macro_name not in defined_macros
-
-        if condition_stack and not condition_stack[-1]:
-            # 已经在一个false条件内，继续跳过
-            condition_stack.append(False)
-        else:
-            condition_stack.append(is_not_defined)
-
-        skip_current_level = not condition_stack[-1]
+    # 处理#undef
+    if directive == 'undef':
+        if not skip_current_level:
+            defined_macros.pop(argument, None)
         return condition_stack, skip_current_level
 
-    # 处理#if defined()
-    elif line_content.startswith('if ') and 'defined' in line_content:
-        match = re.search(r'defined\s*\(([^)]+)\)', line_content)
-        if match:
-            macro_name = match.group(1).strip()
-            is_defined = macro_name in defined_macros
-
-            if condition_stack and not condition_stack[-1]:
-                # 已经在一个false条件内，继续跳过
-                condition_stack.append(False)
+    # 处理#if、#ifdef、#ifndef：外层被跳过时整组都不求值
+    if directive in ('if', 'ifdef', 'ifndef'):
+        parent_active = not skip_current_level
+        value = False
+        if parent_active:
+            if directive == 'ifdef':
+                value = argument in defined_macros
+            elif directive == 'ifndef':
+                value = argument not in defined_macros
             else:
-                condition_stack.append(is_defined)
-
-            skip_current_level = not condition_stack[-1]
-        return condition_stack, skip_current_level
+                value = evaluate_condition(argument, defined_macros, line, line_number, filename)
+        condition_stack.append([parent_active, value, parent_active and value])
+        return condition_stack, not condition_stack[-1][2]
 
-    # 处理通用的#if (新增处理宏值的比较)
-    elif line_content.startswith('if ') and not 'defined' in line_content:
-        if condition_stack and not condition_stack[-1]:
-            # 已经在一个false条件内，继续跳过
-            condition_stack.append(False)
-            skip_current_level = True
-            return condition_stack, skip_current_level
-
-        # 提取条件表达式
-        condition_expr = line_content[3:].strip()
-
-        # 替换所有宏为其值
-        for macro_name, macro_value in defined_macros.items():
-            # 确保只替换完整的宏名，避免部分替换
-            condition_expr = re.sub(r'\b{}\b'.format(re.escape(macro_name)), macro_value, condition_expr)
-
-        # 尝试安全地计算表达式
-        try:
-            # 使用eval安全地计算表达式结果
-            result = eval(condition_expr, {"__builtins__": {}}, {})
-            condition_stack.append(bool(result))
-        except:
-            # 如果计算失败，假设条件为False
-            print_error(f"无法计算条件表达式 '{condition_expr}'，默认为False", line, line_number)
-            condition_stack.append(False)
-
-        skip_current_level = not condition_stack[-1]
-        return condition_stack, skip_current_level
-
-    # 处理#elif
-    elif line_content.startswith('elif '):
+    # 处理#elif：本组已有分支成立时跳过后续所有分支
+    if directive == 'elif':
         if not condition_stack:
-            print_error("在配置文件中发现未配对的#elif", line, line_number)
-            return condition_stack, skip_current_level
-
-        # 如果前面的条件已经为真，则跳过所有后续elif和else
-        if any(condition_stack[:-1]):
-            condition_stack[-1] = False
-            skip_current_level = True
+            print_error("在配置文件中发现未配对的#elif", line, line_number, None, filename)
             return condition_stack, skip_current_level
-
-        # 检查当前elif条件
-        if 'defined(' in line_content:
-            match = re.search(r'defined\s*\(([^)]+)\)', line_content)
-            if match:
-                macro_name = match.group(1).strip()
-                is_defined = macro_name in defined_macros
-                condition_stack[-1] = is_defined
-                skip_current_level = not is_defined
-        else:
-            # 处理值比较的elif (类似#if的处理)
-            condition_expr = line_content[5:].strip()
-
-            # 替换所有宏为其值
-            for macro_name, macro_value in defined_macros.items():
-                condition_expr = re.sub(r'\b{}\b'.format(re.escape(macro_name)), macro_value, condition_expr)
-
-            try:
-                result = eval(condition_expr, {"__builtins__": {}}, {})
-                condition_stack[-1] = bool(result)
-            except:
-                print_error(f"无法计算条件表达式 '{condition_expr}'，默认为False", line, line_number)
-                condition_stack[-1] = False
-
-            skip_current_level = not condition_stack[-1]
-
-        return condition_stack, skip_current_level
+        level = condition_stack[-1]
+        level[2] = False
+        if level[0] and not level[1]:
+            level[2] = evaluate_condition(argument, defined_macros, line, line_number, filename)
+            level[1] = level[2]
+        return condition_stack, not level[2]
 
     # 处理#else
-    elif line_content.startswith('else'):
+    if directive == 'else':
         if not condition_stack:
-            print_error("在配置文件中发现未配对的#else", line, line_number)
+            print_error("在配置文件中发现未配对的#else", line, line_number, None, filename)
             return condition_stack, skip_current_level
-
-        # 如果之前的任何条件已经为真，那么else部分应该跳过
-        if any(condition_stack[:-1]):
-            skip_current_level = True
-        else:
-            # 否则，else部分的执行取决于之前最近的条件求反
-            condition_stack[-1] = not condition_stack[-1]
-            skip_current_level = not condition_stack[-1]
-        return condition_stack, skip_current_level
+        level = condition_stack[-1]
+        level[2] = level[0] and not level[1]
+        level[1] = True
+        return condition_stack, not level[2]
 
     # 处理#endif
-    elif line_content.startswith('endif'):
+    if directive == 'endif':
         if condition_stack:
             condition_stack.pop()
         else:
-            print_error("在配置文件中发现未配对的#endif", line, line_number)
+            print_error("在配置文件中发现未配对的#endif", line, line_number, None, filename)
 
         # 更新skip_current_level状态
-        skip_current_level = condition_stack and not condition_stack[-1]
+        skip_current_level = bool(condition_stack) and not condition_stack[-1][2]
         return condition_stack, skip_current_level
 
     return condition_stack, skip_current_level
 
 # 处理配置文件某一行
-def parse_config_single_line(line, config, line_number, in_swap_block):
+def parse_config_single_line(line, config, line_number, in_swap_block, filename=None):
     """处理配置文件某一行"""
     # 如果行首是{，说明是Swap块的开始
     if line.startswith('Swap = {'):
         if in_swap_block:
-            print_error("大括号嵌套错误，已经在一个 Swap 块内", line, line_number)
+            print_error("大括号嵌套错误，已经在一个 Swap 块内", line, line_number, None, filename)
             return config, in_swap_block, True  # 错误标志
         return config, True, False  # 进入Swap块，无错误
 
     # 如果行首是}，说明是Swap块的结束
     if line == '}':
         if not in_swap_block:
-            print_error("发现未配对的结束大括号 '}'", line, line_number)
+            print_error("发现未配对的结束大括号 '}'", line, line_number, None, filename)
             return config, in_swap_block, True  # 错误标志
         return config, False, False  # 退出Swap块，无错误
 
     # 如果行首是typedef，说明是类型定义
     if line.startswith('typedef '):
         if not in_swap_block:
-            print_error("typedef 必须在 Swap = { } 块内", line, line_number)
+            print_error("typedef 必须在 Swap = { } 块内", line, line_number, None, filename)
             return config, in_swap_block, True  # 错误标志
         if 'Swap' not in config:
             config['Swap'] = line
@@ -231,8 +336,8 @@ def parse_config_single_line(line, config, line_number, in_swap_block):
         if value and value[-1] == ',':
             value = value[:-1].strip()
 
-        # 对于Folder、Files、ExcludeFile、Swap、ExcludePattern键，追加到已有值
-        if key in ['Folder', 'Files', 'Swap', 'ExcludeFile', 'ExcludeHeading', 'ExcludePattern']:
+        # 对于Folder、Files、ExcludeFile、ExcludeDir、Swap、ExcludePattern、Check键，追加到已有值
+        if key in ['Folder', 'Files', 'Swap', 'ExcludeFile', 'ExcludeDir', 'ExcludeHeading', 'ExcludePattern', 'Check']:
             if key not in config:
                 config[key] = value
             else:
@@ -247,7 +352,7 @@ def parse_config_single_line(line, config, line_number, in_swap_block):
 
     # 如果行不为空但不符合任何已知格式，报错
     if line:
-        print_error("无效的配置行格式", line, line_number)
+        print_error("无效的配置行格式", line, line_number, None, filename)
         return config, in_swap_block, True  # 错误标志
 
     return config, in_swap_block, False  # 空行，无错误
@@ -291,6 +396,22 @@ def parse_config_files(config):
 
     return files, exclude_files
 
+# 解析排除目录列表
+def parse_config_exclude_dirs(config):
+    """解析需要排除的目录名列表，支持通配符"""
+    exclude_dirs = []
+    if 'ExcludeDir' in config:
+        for pattern in config['ExcludeDir'].split(','):
+            pattern = pattern.strip()
+            # 去除两边的引号（如果有）
+            if pattern.startswith('"') and pattern.endswith('"'):
+                pattern = pattern[1:-1]
+            elif pattern.startswith("'") and pattern.endswith("'"):
+                pattern = pattern[1:-1]
+            if pattern and pattern not in exclude_dirs:
+                exclude_dirs.append(pattern)
+    return exclude_dirs
+
 # 处理typedef格式的替换规则
 def parse_config_swap_typedef(part):
     # 移除注释部分
@@ -403,9 +524,69 @@ def parse_config_exclude_pattern(config):
                 exclude_pattern.append(pattern)
     return exclude_pattern
 
+# 解析备用编码
+def parse_config_encoding(config):
+    """Encoding = 编码名，文件既没有BOM也不是合法的UTF-8时按此编码解码；未配置或编码名无效时返回None"""
+    encoding = config.get('Encoding', '').strip().strip('"\'')
+    if not encoding:
+        return None
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        print_error(f"未知的编码 '{encoding}'", f"Encoding = {config['Encoding']}")
+        return None
+
+# 解析命名检查规则
+def parse_config_check_rules(config):
+    """Check = 类型 变量名通配符 前缀[|前缀...]，返回 (类型, 变量名通配符, 前缀列表) 列表
+
+    类型为单个标识符时检查该类型的变量声明，为*时检查所有标识符；
+    名称符合通配符的变量必须以其中一个前缀开头，通配符和前缀中可以使用 * ? [...]
+    """
+    check_rules = []
+    if 'Check' in config:
+        for part in config['Check'].split(','):
+            fields = part.split()
+            if not fields:
+                continue
+            if len(fields) != 3:
+                print_error("检查规则格式错误，应为：类型 变量名通配符 前缀[|前缀...]", part.strip())
+                continue
+            type_name, name_pattern, prefixes = fields
+            rule = (type_name, name_pattern, [prefix for prefix in prefixes.split('|') if prefix])
+            if rule not in check_rules:
+                check_rules.append(rule)
+    return check_rules
+
+# 已读取的配置文件行，按 (路径, 大小, 修改时间) 缓存，同一文件被多次包含或多次解析时只读取一次
+_config_lines_cache = {}
+
+# 读取配置文件中需要处理的行
+def read_config_lines(config_file):
+    """返回 (行号, 去除首尾空白的行内容) 列表，空行和注释行已被去掉"""
+    st = os.stat(config_file)
+    key = (os.path.abspath(config_file), st.st_size, st.st_mtime_ns)
+    lines = _config_lines_cache.get(key)
+    if lines is None:
+        lines = []
+        with open(config_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                # 去除行首空格和行尾换行符
+                line = line.strip()
+                # 跳过空行和注释行
+                if not line or line.startswith('//') or line.startswith('/*'):
+                    continue
+                lines.append((line_number, line))
+        _config_lines_cache[key] = lines
+    return lines
+
 # 解析配置文件
-def parse_config(config_file):
-    """解析配置文件"""
+def parse_config(config_file, included_files=None):
+    """解析配置文件
+
+    支持 #include "文件名"，路径相对于当前配置文件所在目录；每个文件在一次解析中只包含一次。
+    included_files不为None时，所有读取过的配置文件 (绝对路径, 大小, 修改时间) 会追加到其中
+    """
     config = {}
     in_swap_block = False
     has_error = False
@@ -417,40 +598,66 @@ def parse_config(config_file):
     condition_stack = []  # 存储当前条件指令的求值结果
     skip_current_level = False  # 是否跳过当前级别
 
-    try:
-        with open(config_file, 'r', encoding='utf-8') as f:
-            for line_number, line in enumerate(f, 1):
-                # 去除行首空格和行尾换行符
-                line = line.strip()
-
-                # 跳过空行和注释行
-                if not line or line.startswith('//') or line.startswith('/*'):
+    # 本次解析中已经包含过的文件，以及正在处理的包含链（用于检测循环包含）
+    seen_files = set()
+
+    def parse_file(path):
+        nonlocal config, in_swap_block, has_error, condition_stack, skip_current_level
+        filename = os.path.basename(path)
+        seen_files.add(os.path.abspath(path))
+        if included_files is not None:
+            st = os.stat(path)
+            included_files.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
+
+        stack_depth = len(condition_stack)
+        line_number = 0
+        for line_number, line in read_config_lines(path):
+            # 处理#include
+            include = re.match(r'#\s*include\s*["<]([^">]+)[">]', line)
+            if include:
+                if skip_current_level:
                     continue
-
-                # 处理预处理指令
-                if line.startswith('#'):
-                    condition_stack, skip_current_level = parse_config_preprocessor_directive(
-                        line, defined_macros, condition_stack, skip_current_level, line_number
-                    )
+                include_path = os.path.join(os.path.dirname(path), include.group(1))
+                if os.path.abspath(include_path) in seen_files:
+                    # 已经包含过的文件不再重复包含，避免规则重复
                     continue
-
-                # 如果当前在跳过的条件块内，则跳过此行
-                if skip_current_level:
+                if not os.path.isfile(include_path):
+                    print_error(f"找不到包含的配置文件 '{include.group(1)}'", line, line_number, None, filename)
+                    has_error = True
                     continue
+                parse_file(include_path)
+                continue
 
-                # 处理配置行
-                config, in_swap_block, line_error = parse_config_single_line(line, config, line_number, in_swap_block)
-                if line_error:
-                    has_error = True
+            # 处理预处理指令
+            if line.startswith('#'):
+                condition_stack, skip_current_level = parse_config_preprocessor_directive(
+                    line, defined_macros, condition_stack, skip_current_level, line_number, filename
+                )
+                continue
 
-        # 检查是否有未闭合的Swap块
-        if in_swap_block:
-            print_error("配置文件末尾缺少结束大括号 '}'", "", line_number)
+            # 如果当前在跳过的条件块内，则跳过此行
+            if skip_current_level:
+                continue
+
+            # 处理配置行
+            config, in_swap_block, line_error = parse_config_single_line(line, config, line_number, in_swap_block, filename)
+            if line_error:
+                has_error = True
+
+        # 条件指令必须在同一个文件内闭合
+        if len(condition_stack) > stack_depth:
+            print_error(f"配置文件中有{len(condition_stack) - stack_depth}个未闭合的条件指令", "", line_number, None, filename)
+            del condition_stack[stack_depth:]
+            skip_current_level = bool(condition_stack) and not condition_stack[-1][2]
             has_error = True
+        return line_number
 
-        # 检查是否有未闭合的条件指令
-        if condition_stack:
-            print_error(f"配置文件中有{len(condition_stack)}个未闭合的条件指令", "", line_number)
+    try:
+        line_number = parse_file(config_file)
+
+        # 检查是否有未闭合的Swap块
+        if in_swap_block:
+            print_error("配置文件末尾缺少结束大括号 '}'", "", line_number, None, os.path.basename(config_file))
             has_error = True
 
         if has_error:
@@ -463,232 +670,851 @@ def parse_config(config_file):
         print(f"{RED}读取配置文件失败: {str(e)}{RESET}")
         return None
 
-# 处理文件
-def collect_replacements(original_lines, swaps, exclude_heading, exclude_pattern):
-    """收集文件中的所有替换位置"""
-    replacements_by_line = []
-    total_replacements = 0
-
-    for line_idx, orig_line in enumerate(original_lines):
-        line_replacements = []
-        line_copy = orig_line  # 使用行的副本来追踪已替换的位置
-        # 用于跟踪已经处理过的位置区间
-        processed_ranges = []
-
-        # 检查当前行是否包含排除的前置标记
-        exclude_heading_pos = -1
-        if exclude_heading:
-            for heading in exclude_heading:
-                pos = orig_line.find(heading)
-                if pos != -1:
-                    exclude_heading_pos = pos
+# 把一组字面量合并为按公共前缀展开的正则
+def build_trie_regex(words):
+    """返回与按长度降序排列的交替分支等价的正则：同一起点优先尝试更长的词，失败时回退到较短的词"""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # 这里也可以作为一个词的结尾时，更长的分支是可选的（贪婪，优先尝试更长的词）
+        return '(?:' + body + ')?' if '' in node else body
+
+    return build(trie)
+
+# 替换规则的正则格式：{0}为所有源文本的首字符，{1}为源文本的字典树
+# 首字符前瞻先排除不可能匹配的位置；零宽断言确保单词前后是空白字符、标点符号或行首尾
+SWAP_PATTERN_FORMAT = r'(?<![a-zA-Z0-9_<])(?=[{0}])(?:{1})(?![a-zA-Z0-9_>])'
+# 替换源前后不能出现的字符，与上面的零宽断言一致
+SWAP_BLOCKED_BEFORE = re.compile(r'[a-zA-Z0-9_<]')
+SWAP_BLOCKED_AFTER = re.compile(r'[a-zA-Z0-9_>]')
+
+# 找出可能在不同起点相互重叠或首尾相接的规则
+def find_overlapping_rules(sources):
+    """返回规则编号的有序列表：源文本a从某个非标识符字符之后开始的后缀是源文本b的前缀，且边界条件允许两者都匹配，
+    例如 a bb 与 bb cc。合并后的正则在同一处取靠左的匹配，而逐条替换时先替换源文本长的规则，这些规则需要单独匹配；
+    只含标识符字符的源文本之间不会出现这种情况"""
+    overlapping = set()
+    for a_id, a in enumerate(sources):
+        for cut in range(1, len(a) + 1):
+            if SWAP_BLOCKED_BEFORE.match(a[cut - 1]):
+                continue
+            rest = a[cut:]
+            for b_id, b in enumerate(sources):
+                if len(b) > len(rest) and b.startswith(rest) and not SWAP_BLOCKED_AFTER.match(b[len(rest)]):
+                    overlapping.update((a_id, b_id))
+    return sorted(overlapping)
+
+# 按规则顺序解决替换位置之间的重叠
+def resolve_overlapping_spans(spans):
+    """按规则编号（源文本长的在前）依次接受替换位置，与已接受的位置重叠或首尾相接的跳过，与逐条替换的结果一致；返回按位置排列的HitSpans"""
+    accepted = []
+    for index in sorted(range(len(spans)), key=spans.rules.__getitem__):
+        span = (spans.lines[index], spans.starts[index], spans.ends[index], spans.rules[index])
+        position = bisect.bisect_left(accepted, span)
+        if position > 0 and accepted[position - 1][0] == span[0] and accepted[position - 1][2] >= span[1]:
+            continue
+        if position < len(accepted) and accepted[position][0] == span[0] and accepted[position][1] <= span[2]:
+            continue
+        accepted.insert(position, span)
+    resolved = HitSpans()
+    for span in accepted:
+        resolved.append(*span)
+    return resolved
+
+# 把标识符通配符转换为正则：* 任意个标识符字符，? 一个标识符字符，[...] 字符集
+def identifier_glob_regex(pattern):
+    parts = []
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        close = pattern.find(']', pos + 2) if char == '[' else -1
+        if char == '*':
+            parts.append(r'\w*')
+        elif char == '?':
+            parts.append(r'\w')
+        elif close != -1:
+            body = pattern[pos + 1:close]
+            # 取反的字符集也只匹配标识符字符
+            parts.append(f"[^{body[1:]}\\W]" if body[0] in '!^' else f"[{body}]")
+            pos = close
+        else:
+            parts.append(re.escape(char))
+        pos += 1
+    return ''.join(parts)
+
+# 命名检查的合并正则：声明分支匹配 类型 [const] [* [const]]... 变量名，标识符分支匹配类型为*的规则关心的所有标识符
+def build_check_pattern(check_rules):
+    """声明分支中type为基本类型，规则按它匹配；const和declarator为其后的修饰，与type一起组成报告中的声明类型"""
+    alternatives = []
+    types = sorted({type_name for type_name, _, _ in check_rules if type_name != '*'}, key=len, reverse=True)
+    if types:
+        alternatives.append(r'(?<!\w)(?P<type>{0})(?P<const>(?:\s+const\b)*)(?P<declarator>(?:\s*[*&](?:\s*const\b)?)*)(?:\s+|(?<=[*&]))'
+                            r'(?!(?:operator|const)\b)(?P<name>[A-Za-z_]\w*){1}'.format(
+            '|'.join(map(re.escape, types)), CHECK_DECLARATOR_END))
+    names = [identifier_glob_regex(name_pattern) for type_name, name_pattern, _ in check_rules if type_name == '*']
+    if names:
+        alternatives.append(r'(?<!\w)(?P<ident>(?:{0}))(?!\w)'.format('|'.join(names)))
+    return '|'.join(alternatives)
+
+# 变量名之后必须是这些字符之一才算声明，排除函数声明和表达式
+CHECK_DECLARATOR_END = r'(?=\s*[;=,)\[{:])'
+
+# 声明中逗号之后的下一个变量名及其指针修饰：bool a = x, *const b;
+CHECK_NEXT_DECLARATOR = re.compile(r'\s*(?:=[^,;(){}]*)?,\s*((?:[*&]\s*(?:const\b\s*)?)*)([A-Za-z_]\w*)' + CHECK_DECLARATOR_END)
+CHECK_NEXT_DECLARATOR_BYTES = re.compile(CHECK_NEXT_DECLARATOR.pattern.encode('ascii'))
+
+# 预编译的替换规则引擎
+class SwapEngine:
+    """由parse_config_swaps的结果构建一次，预览和实际替换共用同一组已编译的正则
+
+    正则在第一次使用时才编译，序列化时只保存正则源码；从配置缓存加载后如果所有文件都命中结果缓存，则完全不需要编译。
+    UTF-8文件直接在原始字节上匹配，其余编码的文件解码后在文本上匹配，fallback_encoding为配置的备用编码
+    """
+
+    def __init__(self, swaps, check_rules=None, fallback_encoding=None):
+        start_time = time.perf_counter()
+        # swaps已经按源长度降序排序，规则编号即为其在列表中的下标
+        self.swaps = list(swaps)
+        self.rule_ids = {src: rule_id for rule_id, (src, _) in enumerate(self.swaps)}
+        self.byte_rule_ids = {src.encode('utf-8'): rule_id for src, rule_id in self.rule_ids.items()}
+        self.fallback_encoding = fallback_encoding
+        # 规则按公共前缀合并成字典树形式的正则，同一起点优先匹配最长的规则
+        first_chars = ''.join(sorted(set(src[0] for src, _ in self.swaps)))
+        self.pattern_source = SWAP_PATTERN_FORMAT.format(re.escape(first_chars), build_trie_regex([src for src, _ in self.swaps]))
+        self._pattern = None
+        self._byte_pattern = None
+        # 可能在不同起点相互重叠的规则，通常为空；非空时改用overlap_patterns匹配
+        self.overlapping_rule_ids = find_overlapping_rules([src for src, _ in self.swaps])
+        self._overlap_patterns = {}
+        # 命名检查规则与替换规则在同一次扫描中处理
+        self.check_rules = list(check_rules or [])
+        self.check_pattern_source = build_check_pattern(self.check_rules) if self.check_rules else None
+        self.check_predicates = [(type_name, re.compile(identifier_glob_regex(name_pattern)),
+                                  re.compile('|'.join(identifier_glob_regex(prefix) for prefix in prefixes)))
+                                 for type_name, name_pattern, prefixes in self.check_rules]
+        self._check_pattern = None
+        self._check_byte_pattern = None
+        self.compile_time = time.perf_counter() - start_time
+        # 每条规则的命中次数
+        self.match_counts = [0] * len(self.swaps)
+        self.check_counts = [0] * len(self.check_rules)
+
+    def __getstate__(self):
+        # 已编译的正则不参与序列化，加载后按需重新编译
+        state = self.__dict__.copy()
+        state['_pattern'] = None
+        state['_byte_pattern'] = None
+        state['_check_pattern'] = None
+        state['_check_byte_pattern'] = None
+        state['_overlap_patterns'] = {}
+        return state
+
+    @property
+    def pattern(self):
+        if self._pattern is None:
+            start_time = time.perf_counter()
+            self._pattern = re.compile(self.pattern_source)
+            self.compile_time += time.perf_counter() - start_time
+        return self._pattern
+
+    @property
+    def byte_pattern(self):
+        # 同样的规则作用在UTF-8原始字节上；边界字符都是ASCII，多字节字符的每个字节都不小于0x80，结果与文本匹配一致
+        if self._byte_pattern is None:
+            start_time = time.perf_counter()
+            self._byte_pattern = re.compile(self.pattern_source.encode('utf-8'))
+            self.compile_time += time.perf_counter() - start_time
+        return self._byte_pattern
+
+    def overlap_patterns(self, binary=False):
+        """有相互重叠的规则时使用：其余规则合并后的正则，以及每条重叠规则单独的正则；binary为True时为bytes正则"""
+        patterns = self._overlap_patterns.get(binary)
+        if patterns is None:
+            start_time = time.perf_counter()
+            overlapping = set(self.overlapping_rule_ids)
+            groups = [[src for rule_id, (src, _) in enumerate(self.swaps) if rule_id not in overlapping]]
+            groups.extend([self.swaps[rule_id][0]] for rule_id in self.overlapping_rule_ids)
+            sources = [SWAP_PATTERN_FORMAT.format(re.escape(''.join(sorted(set(src[0] for src in group)))), build_trie_regex(group))
+                       for group in groups if group]
+            patterns = [re.compile(source.encode('utf-8') if binary else source) for source in sources]
+            self._overlap_patterns[binary] = patterns
+            self.compile_time += time.perf_counter() - start_time
+        return patterns
+
+    @property
+    def check_pattern(self):
+        if self._check_pattern is None and self.check_pattern_source:
+            start_time = time.perf_counter()
+            self._check_pattern = re.compile(self.check_pattern_source)
+            self.compile_time += time.perf_counter() - start_time
+        return self._check_pattern
+
+    @property
+    def check_byte_pattern(self):
+        # 字节版本中\w、\s只匹配ASCII字符，标识符边界与替换规则一致
+        if self._check_byte_pattern is None and self.check_pattern_source:
+            start_time = time.perf_counter()
+            self._check_byte_pattern = re.compile(self.check_pattern_source.encode('utf-8'))
+            self.compile_time += time.perf_counter() - start_time
+        return self._check_byte_pattern
+
+    def may_match(self, data):
+        """原始字节（bytes或mmap）中是否可能存在替换位置或命名检查的对象；不能按字节匹配的内容总是返回True"""
+        if self.byte_pattern.search(data) is not None:
+            return True
+        if self.check_pattern_source and self.check_byte_pattern.search(data) is not None:
+            return True
+        # UTF-16/32和按备用编码解码的内容中，ASCII字节不一定是ASCII字符，要解码后再判断
+        return not byte_matching_reliable(data, self.fallback_encoding)
+
+    def check_name(self, name, type_name=None):
+        """返回名称违反的所有检查规则编号；type_name为None时只检查类型为*的规则"""
+        return [check_id for check_id, (rule_type, name_regex, prefix_regex) in enumerate(self.check_predicates)
+                if (rule_type == '*' or rule_type == type_name)
+                and name_regex.fullmatch(name) and not prefix_regex.match(name)]
+
+    def check_rule_text(self, check_id):
+        """返回检查规则在配置文件中的写法"""
+        type_name, name_pattern, prefixes = self.check_rules[check_id]
+        return f"{type_name} {name_pattern} {'|'.join(prefixes)}"
+
+    def rule_id(self, src):
+        """返回源文本对应的规则编号"""
+        return self.rule_ids[src]
+
+    def dest(self, src):
+        """返回源文本对应的替换目标"""
+        return self.swaps[self.rule_ids[src]][1]
+
+    def count_matches(self, spans):
+        """累计一个文件的规则命中次数（多进程时在主进程中汇总）"""
+        match_counts = self.match_counts
+        for rule_id in spans.rules:
+            match_counts[rule_id] += 1
+
+    def count_findings(self, findings):
+        """累计一个文件的检查规则违反次数"""
+        for finding in findings:
+            self.check_counts[finding[3]] += 1
+
+    def rule_stats(self):
+        """返回每条规则的 (源, 目标, 命中次数)"""
+        return [(src, dest, self.match_counts[rule_id]) for rule_id, (src, dest) in enumerate(self.swaps)]
+
+    def single_rule_pattern(self, rule_id):
+        """只包含一条规则的正则，边界条件与合并后的正则相同，性能分析时用于单独计时"""
+        src = self.swaps[rule_id][0]
+        return re.compile(SWAP_PATTERN_FORMAT.format(re.escape(src[0]), build_trie_regex([src])))
+
+# C/C++ 词法状态
+LEX_CODE = 0
+LEX_STRING = 1
+LEX_CHAR = 2
+LEX_RAW_STRING = 3
+LEX_LINE_COMMENT = 4
+LEX_BLOCK_COMMENT = 5
+
+# 代码状态下需要关注的记号：注释、原始字符串、字符串、字符、带分隔符的数字（1'000）
+# 先用首字符前瞻过滤，绝大多数位置不需要逐个尝试各分支
+LEX_CODE_TOKEN = re.compile(r"""(?=[/"'uULR0-9])(?://|/\*|(?<!\w)(?:u8|[uUL])?R"([^()\\\s"]{0,16})\(|"|'|(?<!\w)\d\w*(?:'\w+)+)""")
+LEX_STRING_BODY = re.compile(r'(?:[^"\\\n]|\\[\s\S])*')
+LEX_CHAR_BODY = re.compile(r"(?:[^'\\\n]|\\[\s\S])*")
+
+# 流式C/C++词法分析器
+class CodeLexer:
+    """逐行标记字符串、字符和注释区域，跨行保留状态（块注释、原始字符串、续行）
+
+    处理str；按字节处理的内容使用ByteCodeLexer，两者只是记号和字符常量的类型不同
+    """
+    CODE_TOKEN = LEX_CODE_TOKEN
+    STRING_BODY = LEX_STRING_BODY
+    CHAR_BODY = LEX_CHAR_BODY
+    TOKEN_STATES = {'//': LEX_LINE_COMMENT, '/*': LEX_BLOCK_COMMENT, '"': LEX_STRING, "'": LEX_CHAR}
+    QUOTE, APOSTROPHE, SLASH, CLOSE_PAREN, BLOCK_COMMENT_END = '"', "'", '/', ')', '*/'
+    # 与 text[pos] 比较的单个字符，bytes中取出的是整数
+    NEWLINE, CARRIAGE_RETURN, BACKSLASH = '\n', '\r', '\\'
+
+    def __init__(self):
+        self.state = LEX_CODE
+        self.raw_terminator = None
+
+    @staticmethod
+    def for_text(text):
+        """返回适合text类型（str或bytes）的新词法分析器"""
+        return ByteCodeLexer() if isinstance(text, bytes) else CodeLexer()
+
+    def feed(self, line):
+        """分析一行，返回 (starts, ends) 两个升序列表表示非代码区域；没有时返回None"""
+        if self.state == LEX_CODE and self.QUOTE not in line and self.APOSTROPHE not in line and self.SLASH not in line:
+            return None
+        starts, ends = self._scan(line)
+        return (starts, ends) if starts else None
+
+    def scan_buffer(self, text):
+        """分析整个文件内容，返回全文偏移的 (starts, ends)，结果与逐行feed一致"""
+        return self._scan(text)
+
+    def _scan(self, text):
+        starts = []
+        ends = []
+        pos = 0
+        length = len(text)
+        code_token = self.CODE_TOKEN
+        token_states = self.TOKEN_STATES
+
+        while pos < length:
+            if self.state == LEX_CODE:
+                match = code_token.search(text, pos)
+                if not match:
                     break
-
-        # 收集这一行的所有替换
-        for src, dest in swaps:  # swaps已经是排序后的规则
-            # 修改正则表达式，确保匹配完整的独立单词
-            # 使用零宽断言，确保单词前后是空白字符、标点符号或行首尾
-            pattern = re.compile(r'(?<![a-zA-Z0-9_<]){0}(?![a-zA-Z0-9_>])'.format(re.escape(src)))
-            # 查找所有匹配，但避免在已替换的位置上再次替换
-            for match in pattern.finditer(orig_line):
-                start, end = match.start(), match.end()
-
-                # 检查匹配位置是否在字符串内（前后都有奇数个分号）
-                before_quotes = orig_line[:start].count('"')
-                after_quotes = orig_line[end:].count('"') 
-                if before_quotes % 2 == 1 and after_quotes % 2 == 1:
+                pos = match.end()
+                state = token_states.get(match.group())
+                if state is not None:
+                    self.state = state
+                elif match.group(1) is not None:
+                    self.state = LEX_RAW_STRING
+                    self.raw_terminator = self.CLOSE_PAREN + match.group(1) + self.QUOTE
+                else:
+                    # 数字分隔符，不是字符字面量
                     continue
+                region_start = match.start()
+            else:
+                # 从上一行延续下来的区域，从行首开始
+                region_start = pos
+
+            pos = self._region_end(text, pos)
+            starts.append(region_start)
+            ends.append(pos)
+
+        return starts, ends
+
+    def _region_end(self, text, pos):
+        """在当前非代码状态下查找区域结束位置，区域闭合时切回代码状态"""
+        length = len(text)
+        state = self.state
+
+        if state == LEX_BLOCK_COMMENT or state == LEX_RAW_STRING:
+            terminator = self.BLOCK_COMMENT_END if state == LEX_BLOCK_COMMENT else self.raw_terminator
+            close = text.find(terminator, pos)
+            if close == -1:
+                return length
+            self.state = LEX_CODE
+            self.raw_terminator = None
+            return close + len(terminator)
+
+        newline, carriage_return, backslash = self.NEWLINE, self.CARRIAGE_RETURN, self.BACKSLASH
+        while True:
+            if state != LEX_LINE_COMMENT:
+                body = self.STRING_BODY if state == LEX_STRING else self.CHAR_BODY
+                pos = body.match(text, pos).end()
+                if pos < length and text[pos] != newline:
+                    # 遇到闭合引号
+                    self.state = LEX_CODE
+                    return pos + 1
+
+            # 行注释或未闭合的字面量到行尾结束，行尾反斜杠续行时延续到下一行
+            line_end = text.find(newline, pos)
+            line_end = length if line_end == -1 else line_end + 1
+            content_end = line_end
+            if content_end > 0 and text[content_end - 1] == newline:
+                content_end -= 1
+            while content_end > 0 and text[content_end - 1] == carriage_return:
+                content_end -= 1
+            if content_end == 0 or text[content_end - 1] != backslash:
+                self.state = LEX_CODE
+                return line_end
+            if line_end >= length:
+                return length
+            pos = line_end
+
+# 按字节处理的C/C++词法分析器
+class ByteCodeLexer(CodeLexer):
+    """在UTF-8原始字节上分析，多字节字符的每个字节都不小于0x80，不会被误认为引号、斜杠或换行"""
+    CODE_TOKEN = re.compile(LEX_CODE_TOKEN.pattern.encode('ascii'))
+    STRING_BODY = re.compile(LEX_STRING_BODY.pattern.encode('ascii'))
+    CHAR_BODY = re.compile(LEX_CHAR_BODY.pattern.encode('ascii'))
+    TOKEN_STATES = {token.encode('ascii'): state for token, state in CodeLexer.TOKEN_STATES.items()}
+    QUOTE, APOSTROPHE, SLASH, CLOSE_PAREN, BLOCK_COMMENT_END = b'"', b"'", b'/', b')', b'*/'
+    NEWLINE, CARRIAGE_RETURN, BACKSLASH = ord('\n'), ord('\r'), ord('\\')
+
+# 判断位置是否落在非代码区域内
+def in_literal_region(regions, pos):
+    """regions为CodeLexer.feed的返回值，二分查找位置所在区域"""
+    starts, ends = regions
+    index = bisect.bisect_right(starts, pos) - 1
+    return index >= 0 and pos < ends[index]
+
+# 一个文件的替换位置
+class HitSpans:
+    """按位置从前到后排列的替换位置，按列保存：行号、起始列、结束列、规则编号
+
+    每处替换只占16字节；源文本和替换目标由规则编号在SwapEngine中查到，显示时才取出
+    """
+    __slots__ = ('lines', 'starts', 'ends', 'rules')
+
+    def __init__(self):
+        self.lines = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.rules = array('i')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __eq__(self, other):
+        return (isinstance(other, HitSpans) and self.lines == other.lines and self.starts == other.starts
+                and self.ends == other.ends and self.rules == other.rules)
+
+    def __getstate__(self):
+        return self.lines, self.starts, self.ends, self.rules
+
+    def __setstate__(self, state):
+        self.lines, self.starts, self.ends, self.rules = state
+
+    def append(self, line_idx, start, end, rule_id):
+        self.lines.append(line_idx)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.rules.append(rule_id)
+
+    def extend(self, other, line_offset=0):
+        """追加另一组替换位置，行号加上line_offset，流式处理时逐块合并"""
+        if line_offset:
+            self.lines.extend(line_idx + line_offset for line_idx in other.lines)
+        else:
+            self.lines.extend(other.lines)
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        self.rules.extend(other.rules)
+
+    def by_line(self):
+        """依次产出 (行号, [(起始列, 结束列, 规则编号), ...])"""
+        lines = self.lines
+        index = 0
+        while index < len(lines):
+            line_idx = lines[index]
+            # 行号升序，二分查找这一行的最后一处替换
+            line_end = bisect.bisect_right(lines, line_idx, index)
+            yield line_idx, list(zip(self.starts[index:line_end], self.ends[index:line_end], self.rules[index:line_end]))
+            index = line_end
+
+    def line_indices(self):
+        """有替换的行号，不重复"""
+        return sorted(set(self.lines))
+
+    def remap_rules(self, rule_map):
+        """返回规则编号按rule_map（旧编号 → 新编号）换算后的副本，规则集变化后沿用缓存结果时使用"""
+        spans = HitSpans()
+        spans.lines, spans.starts, spans.ends = self.lines, self.starts, self.ends
+        spans.rules = array('i', [rule_map[rule_id] for rule_id in self.rules])
+        return spans
+
+# 合并一行中exclude_pattern的出现位置
+def exclude_intervals(line, exclude_pattern):
+    """返回 (起始列列表, 结束列列表)，区间互不重叠且升序；每个模式只取第一次出现的位置"""
+    intervals = []
+    for pattern_text in exclude_pattern:
+        pattern_pos = line.find(pattern_text)
+        if pattern_pos != -1:
+            intervals.append((pattern_pos, pattern_pos + len(pattern_text)))
+    intervals.sort()
+    starts, ends = [], []
+    for interval_start, interval_end in intervals:
+        if ends and interval_start < ends[-1]:
+            ends[-1] = max(ends[-1], interval_end)
+        else:
+            starts.append(interval_start)
+            ends.append(interval_end)
+    return starts, ends
 
-                # 如果这个替换位置在排除前置标记之后，则跳过
-                if exclude_heading_pos != -1 and start > exclude_heading_pos:
-                    continue
+# 处理文件
+def collect_replacements(original_lines, engine, exclude_heading, exclude_pattern, line_ranges=None, timer=None, lexer=None):
+    """收集文件中的所有替换位置和命名检查结果，返回 (HitSpans, 替换数量, 检查结果)
+
+    line_ranges为升序且互不重叠的 (起始行, 结束行) 列表（从0开始，不含结束行），指定时只收集这些行内的结果；
+    timer为PhaseTimer时分别记录词法分析、匹配（含排除检查）和命名检查的时间；
+    lexer为上一块内容使用的CodeLexer时延续其状态，用于流式处理（不能与line_ranges同时使用）；
+    original_lines为bytes行（见decode_source）时直接在字节上匹配，列号为字节偏移
+    """
+    timer = timer or NULL_PHASE_TIMER
+    spans = HitSpans()
+
+    # 整个文件作为一个缓冲区扫描，行首偏移表只用于把匹配位置换算成 (行, 列)
+    if original_lines and isinstance(original_lines[0], bytes):
+        text = b''.join(original_lines)
+        pattern, rule_ids = engine.byte_pattern, engine.byte_rule_ids
+        exclude_heading = [heading.encode('utf-8') for heading in exclude_heading or ()]
+        exclude_pattern = [pattern_text.encode('utf-8') for pattern_text in exclude_pattern or ()]
+    else:
+        text = ''.join(original_lines)
+        pattern, rule_ids = engine.pattern, engine.rule_ids
+    line_starts = list(accumulate(map(len, original_lines), initial=0))
+    if line_ranges is not None:
+        line_ranges = [(first, min(last, len(original_lines))) for first, last in line_ranges if first < len(original_lines)]
+
+    def find_matches(pattern):
+        if line_ranges is None:
+            return pattern.finditer(text)
+        return chain.from_iterable(pattern.finditer(text, line_starts[first], line_starts[last]) for first, last in line_ranges)
+
+    if engine.overlapping_rule_ids:
+        # 有相互重叠的规则时各自单独匹配，按位置合并，排除检查之后再按规则顺序解决重叠
+        matches = heapq.merge(*map(find_matches, engine.overlap_patterns(isinstance(text, bytes))), key=lambda match: match.start())
+    else:
+        matches = find_matches(pattern)
+    if line_ranges is None:
+        # 词法分析器在整个文件内延续状态，多行注释和原始字符串也能正确识别
+        regions = (lexer or CodeLexer.for_text(text)).scan_buffer(text)
+    else:
+        # 词法分析仍从文件开头开始，只是到最后一个范围结束为止，保证范围内的状态正确
+        regions = CodeLexer.for_text(text).scan_buffer(text[:line_starts[line_ranges[-1][1]]] if line_ranges else text[:0])
+    timer.lap('lex')
+
+    line_idx = -1
+    for match in matches:
+        # 检查匹配位置是否在字符串、字符或注释内
+        if in_literal_region(regions, match.start()):
+            continue
 
-                # 如果这个替换位置前后符合exclude_pattern，则跳过
-                if exclude_pattern:
-                    for pattern in exclude_pattern:
-                        pattern_pos = orig_line.find(pattern)
-                        if pattern_pos != -1 and not (pattern_pos + len(pattern) <= start or pattern_pos >= end):
-                            continue
-
-                # 检查这个范围是否已经被处理过
-                overlap = False
-                for p_start, p_end in processed_ranges:
-                    # 检查是否有重叠
-                    if (start <= p_end and end >= p_start):
-                        overlap = True
+        # finditer按位置从前到后返回，换行时准备这一行的排除信息
+        match_line = bisect.bisect_right(line_starts, match.start()) - 1
+        if match_line != line_idx:
+            line_idx = match_line
+            line_start = line_starts[line_idx]
+            orig_line = original_lines[line_idx]
+
+            # 检查当前行是否包含排除的前置标记
+            exclude_heading_pos = -1
+            if exclude_heading:
+                for heading in exclude_heading:
+                    pos = orig_line.find(heading)
+                    if pos != -1:
+                        exclude_heading_pos = pos
                         break
 
-                if overlap:
-                    continue
-
-                pre = orig_line[max(0, start-10):start]
-                original = orig_line[start:end]
-                post = orig_line[end:end+10]
-
-                # 检查这个位置是否已经被替换过
-                if original == src:  # 确保完全匹配原始字符串
-                    # 将start和end也加入到替换信息中
-                    line_replacements.append((pre, original, post, dest, start, end))
-                    # 记录已处理的范围
-                    processed_ranges.append((start, end))
+            # 排除模式的出现位置合并成有序区间，每处匹配二分查找一次
+            if exclude_pattern:
+                excluded_starts, excluded_ends = exclude_intervals(orig_line, exclude_pattern)
 
-        if line_replacements:
-            # 按位置排序，从前到后
-            line_replacements.sort(key=lambda x: x[4])  # 使用start位置来排序
-            replacements_by_line.append((line_idx, line_replacements))
-            total_replacements += len(line_replacements)
+        start, end = match.start() - line_start, match.end() - line_start
 
-    return replacements_by_line, total_replacements
+        # 如果这个替换位置在排除前置标记之后，则跳过
+        if exclude_heading_pos != -1 and start > exclude_heading_pos:
+            continue
 
-# 显示所有替换位置
-def display_replacements(filepath, replacements_by_line):
-    rel_path = os.path.relpath(filepath)
+        # 如果这个替换位置与exclude_pattern的出现位置重叠，则跳过
+        if exclude_pattern and excluded_starts:
+            index = bisect.bisect_left(excluded_starts, end) - 1
+            if index >= 0 and excluded_ends[index] > start:
+                continue
 
-    # 读取文件内容
-    with open(filepath, 'r', encoding='utf-8') as f:
-        original_lines = f.readlines()
+        spans.append(line_idx, start, end, rule_ids[match.group()])
+    if engine.overlapping_rule_ids:
+        spans = resolve_overlapping_spans(spans)
+    timer.lap('match')
+
+    # 命名检查复用同一个缓冲区、词法区域和行首偏移表
+    findings = []
+    if engine.check_rules:
+        findings = collect_check_findings(text, line_starts, regions, engine, line_ranges)
+        timer.lap('check')
+
+    return spans, len(spans), findings
+
+# 收集命名检查结果
+def collect_check_findings(text, line_starts, regions, engine, line_ranges=None):
+    """返回 (行, 起始列, 结束列, 检查规则编号, 名称, 声明类型) 列表，按位置排序；text为bytes时列号为字节偏移，名称解码为str
+
+    声明类型保留指针修饰和其后的const（如 int * const），规则只按其中的基本类型匹配；类型为*的规则只看名称，
+    命中时总是没有声明类型，名称出现在其他规则类型的声明中也一样
+    """
+    findings = []
+    binary = isinstance(text, bytes)
+    check_pattern = engine.check_byte_pattern if binary else engine.check_pattern
+    next_declarator = CHECK_NEXT_DECLARATOR_BYTES if binary else CHECK_NEXT_DECLARATOR
+
+    def add(name, start, type_name, qualifiers=None, typed_only=False):
+        if in_literal_region(regions, start):
+            return
+        line_idx = bisect.bisect_right(line_starts, start) - 1
+        column = start - line_starts[line_idx]
+        end = column + len(name)
+        if binary:
+            name = name.decode('utf-8')
+            type_name = type_name.decode('utf-8') if type_name is not None else None
+            qualifiers = [qualifier.decode('utf-8') for qualifier in qualifiers] if qualifiers is not None else None
+        declared = declared_type(type_name, qualifiers) if type_name is not None else None
+        for check_id in engine.check_name(name, type_name):
+            if engine.check_rules[check_id][0] != '*':
+                findings.append((line_idx, column, end, check_id, name, declared))
+            elif not typed_only:
+                findings.append((line_idx, column, end, check_id, name, None))
+
+    if line_ranges is None:
+        matches = check_pattern.finditer(text)
+    else:
+        matches = chain.from_iterable(check_pattern.finditer(text, line_starts[first], line_starts[last])
+                                      for first, last in line_ranges)
+    for match in matches:
+        if match.lastgroup == 'ident':
+            add(match.group('ident'), match.start('ident'), None)
+            continue
 
-    for line_idx, line_replacements in replacements_by_line:
-        # 获取原始行内容
-        original_line = original_lines[line_idx]
+        type_name, leading_const = match.group('type'), match.group('const') or text[:0]
+        add(match.group('name'), match.start('name'), type_name, (leading_const, match.group('declarator')))
+        # 同一声明中逗号分隔的其余变量只按类型检查，类型为*的规则会在后续匹配中单独处理；指针修饰各自不同
+        following = next_declarator.match(text, match.end())
+        while following:
+            add(following.group(2), following.start(2), type_name, (leading_const, following.group(1)), True)
+            following = next_declarator.match(text, following.end())
+
+    findings.sort()
+    return findings
+
+# 报告中的声明类型：基本类型加上其后的const和指针、引用修饰，连续空白合并为一个空格
+def declared_type(type_name, qualifiers):
+    leading_const, declarator = (' '.join(qualifier.split()) for qualifier in qualifiers)
+    return ' '.join(part for part in (type_name, leading_const, declarator) if part)
+
+# 把按字节处理的行解码为文本，只在显示和输出时调用
+def decode_line(line):
+    return line if isinstance(line, str) else line.decode('utf-8', 'replace')
+
+# 把行内列号换算为字符偏移
+def char_column(line, column):
+    """按字节处理的行中列号是字节偏移，前面有非ASCII字符时换算为字符偏移；str行原样返回"""
+    if isinstance(line, str) or line.isascii():
+        return column
+    return len(line[:column].decode('utf-8', 'replace'))
+
+# 渲染一行替换前后的内容
+def render_replacement_line(orig_line, line_spans, engine, old_color='', new_color='', reset=''):
+    """一次遍历同时拼出旧行和新行，替换部分可用颜色标记包裹"""
+    if isinstance(orig_line, bytes):
+        line_spans = [(char_column(orig_line, start), char_column(orig_line, end), rule_id) for start, end, rule_id in line_spans]
+        orig_line = decode_line(orig_line)
+    old_segments = []
+    new_segments = []
+    last_pos = 0
+    # line_spans已按位置从前到后排列，且互不重叠
+    for start, end, rule_id in line_spans:
+        unchanged = orig_line[last_pos:start]
+        old_segments.append(unchanged)
+        old_segments.append(f"{old_color}{orig_line[start:end]}{reset}")
+        new_segments.append(unchanged)
+        new_segments.append(f"{new_color}{engine.swaps[rule_id][1]}{reset}")
+        last_pos = end
+    old_segments.append(orig_line[last_pos:])
+    new_segments.append(orig_line[last_pos:])
+    return ''.join(old_segments).strip(), ''.join(new_segments).strip()
+
+# 渲染文件的所有替换位置
+def render_replacements(spans, original_lines, engine, colored=False, max_hits=None):
+    """依次产出 (行前缀, 旧行, 新行)，控制台和修改日志共用；max_hits限制最多渲染的替换数量"""
+    old_color, new_color, reset = (RED, GREEN, RESET) if colored else ('', '', '')
+    remaining = max_hits
+    for line_idx, line_spans in spans.by_line():
+        if remaining is not None:
+            if remaining <= 0:
+                return
+            line_spans = line_spans[:remaining]
+            remaining -= len(line_spans)
 
         # 构建前缀（行号）
         line_num_str = f"{line_idx + 1:04d}"
-        prefix = f"{GRAY}LINE {line_num_str}:{RESET}  "
-
-        # 创建原始行，不包含任何着色
-        old_line = original_line
-
-        # 创建新行（应用所有替换）
-        new_line = original_line
-        # 从后向前替换，避免位置偏移
-        for pre, original, post, dest, start, end in sorted(line_replacements, key=lambda x: x[4], reverse=True):
-            new_line = new_line[:start] + dest + new_line[end:]
-
-        # 为原始行和新行添加彩色标记
-        # 原始行：每个被替换的部分标记为红色
-        colored_segments_old = []
-        last_pos = 0
-
-        for pre, original, post, dest, start, end in sorted(line_replacements, key=lambda x: x[4]):
-            # 添加未替换的部分
-            if start > last_pos:
-                segment = old_line[last_pos:start]
-                colored_segments_old.append(segment)
-            # 添加替换的部分（红色）
-            colored_segments_old.append(f"{RED}{original}{RESET}")
-            last_pos = end
-
-        # 添加最后一部分
-        if last_pos < len(old_line):
-            segment = old_line[last_pos:]
-            colored_segments_old.append(segment)
-
-        # 新行：计算替换后的新位置
-        new_positions = []
-        offset = 0
-
-        for pre, original, post, dest, start, end in sorted(line_replacements, key=lambda x: x[4]):
-            new_pos = start + offset
-            new_positions.append((new_pos, dest))
-            offset += len(dest) - len(original)
-
-        # 为新行添加彩色标记
-        colored_segments_new = []
-        last_pos = 0
-
-        for pos, dest in new_positions:
-            # 添加未替换的部分
-            if pos > last_pos:
-                segment = new_line[last_pos:pos]
-                colored_segments_new.append(segment)
-            # 添加替换的部分（绿色）
-            colored_segments_new.append(f"{GREEN}{dest}{RESET}")
-            last_pos = pos + len(dest)
-
-        # 添加最后一部分
-        if last_pos < len(new_line):
-            segment = new_line[last_pos:]
-            colored_segments_new.append(segment)
-
-        # 组合成最终的彩色字符串
-        colored_old_line = ''.join(colored_segments_old).strip()
-        colored_new_line = ''.join(colored_segments_new).strip()
+        prefix = f"{GRAY}LINE {line_num_str}:{RESET}  " if colored else f"LINE {line_num_str}:  "
+
+        old_line, new_line = render_replacement_line(original_lines[line_idx], line_spans, engine, old_color, new_color, reset)
+        yield prefix, old_line, new_line
 
+# 显示所有替换位置
+def display_replacements(filepath, spans, original_lines, engine, max_hits=None):
+    for prefix, colored_old_line, colored_new_line in render_replacements(spans, original_lines, engine, True, max_hits):
         # 打印旧行和新行
         print(f"{prefix}{colored_old_line}")
         print(f"{' ' * (len(prefix) - 12)}→  {colored_new_line}")
 
-def apply_replacements(original_lines, swaps):
-    """应用替换到文件内容"""
-    modified = False
-    modified_lines = original_lines.copy()
-
-    for line_idx in range(len(modified_lines)):
-        new_line = modified_lines[line_idx]
-        for src, dest in swaps:
-            # 修改正则表达式，确保匹配完整的独立单词
-            # 使用零宽断言，确保单词前后是空白字符、标点符号或行首尾
-            pattern = re.compile(r'(?<![a-zA-Z0-9_<]){0}(?![a-zA-Z0-9_>])'.format(re.escape(src)))
-            new_line, count = pattern.subn(dest, new_line)
-            if count > 0:
-                modified = True
-        modified_lines[line_idx] = new_line
+    if max_hits is not None:
+        hidden = len(spans) - max_hits
+        if hidden > 0:
+            print(f"{GRAY}…… 还有 {hidden} 处替换未显示{RESET}")
 
-    return modified, modified_lines
-
-def find_pointer_definitions(filepath):
-    """查找文件中的指针变量定义"""
+def apply_replacements(original_lines, spans, engine):
+    """按预览时收集到的位置应用替换，不再重新扫描文件"""
+    modified_lines = original_lines.copy()
+    if spans and isinstance(original_lines[spans.lines[0]], bytes):
+        replacements, join = [dest.encode('utf-8') for _, dest in engine.swaps], b''.join
+    else:
+        replacements, join = [dest for _, dest in engine.swaps], ''.join
+
+    # 顺序遍历各列，行号变化时拼接上一行；同一行的替换已按位置排列，且互不重叠
+    current_idx = -1
+    segments = []
+    last_pos = 0
+    for line_idx, start, end, rule_id in zip(spans.lines, spans.starts, spans.ends, spans.rules):
+        if line_idx != current_idx:
+            if segments:
+                segments.append(original_lines[current_idx][last_pos:])
+                modified_lines[current_idx] = join(segments)
+                segments = []
+            current_idx = line_idx
+            last_pos = 0
+        segments.append(original_lines[line_idx][last_pos:start])
+        segments.append(replacements[rule_id])
+        last_pos = end
+    if segments:
+        segments.append(original_lines[current_idx][last_pos:])
+        modified_lines[current_idx] = join(segments)
+
+    return bool(spans), modified_lines
+
+# 指针定义分析用的预编译正则
+# 可能含指针声明的语句：从语句边界开始到分号为止，第一个*之前是标识符、>、::或逗号，且之前没有括号和等号
+# 不符合的语句（赋值、函数调用、控制语句、return等）在正则内部就被跳过
+POINTER_STATEMENT = re.compile(r'(?<=[;{}])(?!\s*(?:return|delete|throw|case|goto)\b)[^;{}(*=]*[\w>:,]\s*\*[^;]*;')
+# 声明符列表中需要关注的字符
+DECLARATOR_PUNCTUATION = re.compile(r'[()\[\]{}=<>,]')
+# 预处理指令行，分析前和字符串、注释一起被替换为空格
+PREPROCESSOR_LINE = re.compile(r'^[ \t]*#.*$', re.MULTILINE)
+# 声明开头粘贴进来的行号（如testBench.cpp）、访问控制和存储类修饰，const/volatile属于类型的一部分
+POINTER_DECL_PREFIX = r'\s*(?:\d\w*\s+)*(?:(?:public|protected|private)\s*:\s*)?(?:(?:static|extern|inline|register|mutable|constexpr|thread_local)\s+)*'
+# 类型：标识符、::、模板参数和空白组成
+POINTER_DECL_TYPE = r'(?P<type>[A-Za-z_][\w:<>,\s]*?)'
+# 单个声明符的结尾：可选的数组维度和初始值
+POINTER_DECL_TAIL = r'\s*(?P<array>\[[^\]]*\])?\s*(?:=.*|\{.*\})?'
+# 指针修饰：一个或多个*，每个*之后可以有const/volatile，如 * const、*const *
+POINTER_DECL_STARS = r'(?P<stars>\*(?:\s*(?:\*|(?:const|volatile)\b))*)'
+# 第一个声明符为指针：类型 [const] *[const] 变量名 [[]] [= 初始值]
+POINTER_FIRST_DECL = re.compile(POINTER_DECL_PREFIX + POINTER_DECL_TYPE + r'\s*' + POINTER_DECL_STARS + r'\s*(?P<name>[A-Za-z_]\w*)' + POINTER_DECL_TAIL, re.DOTALL)
+# 第一个声明符为成员指针：类型 类名::*变量名 [= 初始值]
+POINTER_MEMBER_DECL = re.compile(POINTER_DECL_PREFIX + POINTER_DECL_TYPE + r'\s+(?P<cls>[A-Za-z_]\w*)::\*\s*(?P<name>[A-Za-z_]\w*)\s*(?:=.*)?', re.DOTALL)
+# 第一个声明符不是指针：类型 变量名 [[]] [= 初始值]，后面的声明符仍可能是指针
+POINTER_PLAIN_DECL = re.compile(POINTER_DECL_PREFIX + POINTER_DECL_TYPE + r'\s+(?P<name>[A-Za-z_]\w*)' + POINTER_DECL_TAIL, re.DOTALL)
+# 逗号之后的声明符：*[const] 变量名 [[]] [= 初始值]
+POINTER_NEXT_DECL = re.compile(r'\s*' + POINTER_DECL_STARS + r'\s*(?P<name>[A-Za-z_]\w*)' + POINTER_DECL_TAIL, re.DOTALL)
+# 这些关键字开头的语句不是声明
+POINTER_NON_TYPES = {'return', 'delete', 'throw', 'case', 'goto', 'sizeof', 'new', 'else', 'do', 'typedef', 'using',
+                     'co_return', 'co_yield', 'operator', 'template'}
+
+# 屏蔽字面量时保留的换行
+MASK_NON_NEWLINE = re.compile(r'[^\n]')
+MASK_NON_NEWLINE_BYTES = re.compile(rb'[^\n]')
+
+# 把字符串、字符和注释替换为空格
+def mask_literals(text, lexer=None):
+    """换行保持不变，结果与原文长度相同、偏移量一致；lexer为上一段内容使用的CodeLexer时延续其状态；text可以是bytes"""
+    starts, ends = (lexer or CodeLexer.for_text(text)).scan_buffer(text)
+    binary = isinstance(text, bytes)
+    newline, space, non_newline = (b'\n', b' ', MASK_NON_NEWLINE_BYTES) if binary else ('\n', ' ', MASK_NON_NEWLINE)
+    segments = []
+    last_pos = 0
+    for start, end in zip(starts, ends):
+        segments.append(text[last_pos:start])
+        region = text[start:end]
+        segments.append(non_newline.sub(space, region) if newline in region else space * len(region))
+        last_pos = end
+    segments.append(text[last_pos:])
+    return text[:0].join(segments)
+
+# 按顶层逗号切分声明符列表，括号和初始值内部的逗号不切分
+def split_declarators(statement):
+    """返回 (起始偏移, 声明符文本) 列表；第一个声明符中<>内的逗号属于模板参数，也不切分"""
+    if ',' not in statement:
+        return [(0, statement)]
+    parts = []
+    depth = 0
+    angle_depth = 0
+    in_initializer = False
+    part_start = 0
+    for match in DECLARATOR_PUNCTUATION.finditer(statement):
+        char = match.group()
+        pos = match.start()
+        if char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif depth == 0:
+            if char == '=':
+                in_initializer = True
+            elif not in_initializer and not parts and char == '<':
+                angle_depth += 1
+            elif not in_initializer and not parts and char == '>':
+                angle_depth -= 1
+            elif char == ',' and angle_depth <= 0:
+                parts.append((part_start, statement[part_start:pos]))
+                part_start = pos + 1
+                in_initializer = False
+    parts.append((part_start, statement[part_start:]))
+    return parts
+
+# 查找指针变量定义
+def find_pointer_definitions(original_lines, lexer=None):
+    """在已读入的行上查找指针变量定义，返回 (行号, 指针类型, 类别, 行内容) 列表
+
+    以语句为单位分析，支持跨行的声明和逗号分隔的多个声明符；字符串、注释和预处理指令中的内容被忽略。
+    lexer见mask_literals，流式处理时逐块调用
+    """
     pointer_definitions = []
+    text = ''.join(original_lines)
+    if '*' not in text and lexer is None:
+        return pointer_definitions
+    line_starts = list(accumulate(map(len, original_lines), initial=0))
+
+    # 开头补一个分号作为第一条语句的边界，偏移量相应减一
+    code = ';' + PREPROCESSOR_LINE.sub(lambda match: ' ' * len(match.group()), mask_literals(text, lexer))
+
+    def add(offset, pointer_type, pointer_category):
+        line_idx = bisect.bisect_right(line_starts, offset) - 1
+        pointer_definitions.append((line_idx + 1, pointer_type, pointer_category, original_lines[line_idx].strip()))
+
+    for statement_match in POINTER_STATEMENT.finditer(code):
+        statement = statement_match.group()[:-1]
+        statement_start = statement_match.start() - 1
+        declarators = split_declarators(statement)
+
+        # 第一个声明符中初始值之前有括号的，是函数声明、函数调用或函数指针，跳过
+        first_offset, first = declarators[0]
+        if '(' in first.split('=', 1)[0]:
+            continue
 
-    try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        match = POINTER_MEMBER_DECL.fullmatch(first) if '::' in first else None
+        if match:
+            base_type = ' '.join(match.group('type').split())
+            if base_type.split()[0] not in POINTER_NON_TYPES:
+                add(statement_start + first_offset + match.start('name'),
+                    f"{base_type} {match.group('cls')}::*{match.group('name')}", "成员指针")
+            continue
 
-        for line_idx, line in enumerate(lines, 1):
-            # 跳过空行和注释行
-            line = line.strip()
-            if not line or line.startswith('//') or line.startswith('/*'):
-                continue
+        match = POINTER_FIRST_DECL.fullmatch(first) or POINTER_PLAIN_DECL.fullmatch(first)
+        if not match:
+            continue
+        base_type = ' '.join(match.group('type').split())
+        if base_type.split()[0] in POINTER_NON_TYPES:
+            continue
 
-            # 排除明显不是变量定义的行
-            if '(' in line and ')' in line and '*' in line and line.index('(') < line.index('*'):
-                # 可能是函数声明或定义，跳过
+        for index, (offset, declarator) in enumerate(declarators):
+            if index > 0:
+                match = POINTER_NEXT_DECL.fullmatch(declarator)
+                if not match:
+                    continue
+            elif 'stars' not in match.groupdict():
                 continue
-
-            # 查找指针定义的模式
-            # 1. 基本指针变量: 类型 [const] *[const] 变量名 [= 初始值];
-            # 2. 数组指针变量: 类型 [const] *[const] 变量名[] [= 初始值];
-            # 3. 成员指针变量: 类型 类名::*变量名 [= 初始值];
-
-            # 基本指针变量模式 - 使用\s+和\s*匹配多个空格或Tab
-            basic_ptr_pattern = r'((?:const\s+)?(?:\w+)(?:::\w+)?(?:\s+const)?\s*\*+\s*(?:const\s+)?\s*(\w+))(?:\s*=\s*[^;]+)?;'
-
-            # 数组指针变量模式 - 同样使用\s+和\s*匹配多个空格或Tab
-            array_ptr_pattern = r'((?:const\s+)?(?:\w+)(?:::\w+)?(?:\s+const)?\s*\*+\s*(?:const\s+)?\s*(\w+)\s*\[\])(?:\s*=\s*[^;]+)?;'
-
-            # 成员指针变量模式 - 同样使用\s+和\s*匹配多个空格或Tab
-            member_ptr_pattern = r'((?:const\s+)?(?:\w+)\s+(\w+)::\*\s*(\w+))(?:\s*=\s*[^;]+)?;'
-
-            # 查找所有匹配
-            for pattern_name, pattern in [
-                ("基本指针", basic_ptr_pattern),
-                ("数组指针", array_ptr_pattern),
-                ("成员指针", member_ptr_pattern)
-            ]:
-                for match in re.finditer(pattern, line):
-                    if pattern_name == "基本指针" or pattern_name == "数组指针":
-                        ptr_type = match.group(1)
-                        ptr_name = match.group(2)
-                    else:  # 成员指针
-                        ptr_type = match.group(1)
-                        class_name = match.group(2)
-                        ptr_name = match.group(3)
-
-                    pointer_definitions.append((line_idx, ptr_type, pattern_name, line))
-
-    except Exception as e:
-        print(f"{RED}读取文件失败 {filepath}: {str(e)}{RESET}")
+            # 指针修饰中的const/volatile保留在类型中，空白合并为一个空格
+            stars = ' '.join(match.group('stars').split())
+            pointer_type = f"{base_type} {stars}{' ' if stars[-1].isalpha() else ''}{match.group('name')}"
+            if match.group('array') is not None:
+                add(statement_start + offset + match.start('name'), pointer_type + ''.join(match.group('array').split()), "数组指针")
+            else:
+                add(statement_start + offset + match.start('name'), pointer_type, "基本指针")
 
     return pointer_definitions
 
@@ -704,39 +1530,1086 @@ def display_pointer_definitions(filepath, definitions):
         print(f"      {line}")
     print(f"{CYAN}======================{RESET}\n")
 
-def log_changes(filepath, replacements_by_line, original_lines, log_file):
+# 显示命名检查结果
+def display_check_findings(findings, original_lines, engine):
+    for line_idx, start, end, check_id, name, declared in findings:
+        line = original_lines[line_idx]
+        start, end = char_column(line, start), char_column(line, end)
+        line = decode_line(line).rstrip('\r\n')
+        print(f"{GRAY}CHECK {line_idx + 1:04d}:{RESET} {line[:start]}{RED}{name}{RESET}{line[end:]}")
+        declared = f"（声明类型 {declared}）" if declared else ''
+        print(f"{' ' * 12}{YELLOW}不符合命名规则: {engine.check_rule_text(check_id)}{declared}{RESET}")
+
+# 显示每条检查规则的违反次数
+def display_check_results(engine, file=None):
+    if not engine.check_rules:
+        return
+    print(f"\n{CYAN}===== 命名检查结果 ====={RESET}", file=file)
+    for check_id, count in enumerate(engine.check_counts):
+        color = RED if count else GREEN
+        print(f"{color}{count:6d}{RESET}  {engine.check_rule_text(check_id)}", file=file)
+
+def log_changes(filepath, spans, original_lines, log_file, engine):
     """记录修改内容到日志文件"""
     rel_path = os.path.relpath(filepath)
     log_file.write(f"\n{'='*80}\n")
     log_file.write(f"文件: {rel_path}\n")
     log_file.write(f"{'='*80}\n\n")
 
-    for line_idx, line_replacements in replacements_by_line:
-        # 获取原始行内容
-        original_line = original_lines[line_idx]
+    for prefix, old_line, new_line in render_replacements(spans, original_lines, engine):
+        # 写入日志文件
+        log_file.write(f"{prefix}{old_line}\n")
+        log_file.write(f"{' ' * (len(prefix) - 12)}→  {new_line}\n\n")
+
+# 第一行开头的BOM不算作内容，返回它占的字符数
+def leading_bom_chars(line_idx, line):
+    return int(line_idx == 0 and line.startswith(codecs.BOM_UTF8 if isinstance(line, bytes) else '\ufeff'))
+
+# 逐条产出机器可读的命中记录
+def iter_hit_records(filepath, engine, spans, pointer_definitions, max_hits=None, findings=(), lines=None):
+    """行号和列号都从1开始，列号按字符计，第一行从BOM之后算起；max_hits限制每个文件最多输出的替换记录数；
+    lines为按字节处理的行时，用它把字节偏移换算为字符偏移"""
+    column = ((lambda line_idx, start: start) if lines is None else
+              (lambda line_idx, start: char_column(lines[line_idx], start) - leading_bom_chars(line_idx, lines[line_idx])))
+    swap_records = ({'file': filepath, 'line': line_idx + 1, 'col': column(line_idx, start) + 1, 'rule': rule_id,
+                     'src': engine.swaps[rule_id][0], 'dest': engine.swaps[rule_id][1], 'category': 'swap'}
+                    for line_idx, start, rule_id in zip(spans.lines, spans.starts, spans.rules))
+    yield from islice(swap_records, max_hits)
+    for line_idx, start, end, check_id, name, declared in findings or ():
+        yield {'file': filepath, 'line': line_idx + 1, 'col': column(line_idx, start) + 1, 'rule': f"check{check_id}",
+               'src': name, 'dest': None, 'category': 'check', 'type': declared}
+    for line_number, pointer_type, pointer_category, line in pointer_definitions or ():
+        yield {'file': filepath, 'line': line_number, 'col': None, 'rule': 'pointer',
+               'src': pointer_type, 'dest': None, 'category': pointer_category}
+
+# 文本报告：彩色输出到控制台
+class TextReporter:
+    """quiet为True时不输出每个文件的详细内容，只保留最后的统计"""
+
+    def __init__(self, quiet=False, max_hits=None, engine=None):
+        self.quiet = quiet
+        self.max_hits = max_hits
+        self.engine = engine
+
+    def note(self, message):
+        if not self.quiet:
+            print(message)
+
+    def report_file(self, file_index, filepath, result, check_pointer):
+        if self.quiet:
+            return
+        abs_path = os.path.abspath(filepath)
+        separator = "-" * 120
+        print(f"{YELLOW}{separator}{RESET}")
+        print(f"{YELLOW}处理文件 [{file_index}]: {abs_path}{RESET}")
+        print(f"{YELLOW}{separator}{RESET}")
 
-        # 构建前缀（行号）
-        line_num_str = f"{line_idx + 1:04d}"
-        prefix = f"LINE {line_num_str}:  "
+        # 显示替换位置
+        display_replacements(filepath, result.replacements, result.lines, self.engine, self.max_hits)
 
-        # 创建原始行，不包含任何着色
-        old_line = original_line
+        # 如果没有找到替换项目，显示提示信息
+        if result.count == 0:
+            print(f"{GRAY}没有查找到可替换项目{RESET}")
 
-        # 创建新行（应用所有替换）
-        new_line = original_line
-        # 从后向前替换，避免位置偏移
-        for pre, original, post, dest, start, end in sorted(line_replacements, key=lambda x: x[4], reverse=True):
-            new_line = new_line[:start] + dest + new_line[end:]
+        if result.findings:
+            display_check_findings(result.findings, result.lines, self.engine)
 
-        # 写入日志文件
-        log_file.write(f"{prefix}{old_line.strip()}\n")
-        log_file.write(f"{' ' * (len(prefix) - 12)}→  {new_line.strip()}\n\n")
+        if check_pointer:
+            display_pointer_definitions(filepath, result.pointers)
+
+    def report_error(self, file_index, filepath, message):
+        # 安静模式下也输出，写到stderr
+        print(f"{YELLOW}跳过文件 [{file_index}]: {os.path.abspath(filepath)}（{message}）{RESET}", file=sys.stderr)
+
+    def flush(self):
+        sys.stdout.flush()
+
+    def close(self):
+        self.flush()
+
+# JSON Lines报告：每条命中一行JSON，边处理边写出
+class JsonlReporter:
+    """提示信息写到stderr，保证输出流中只有记录"""
+
+    def __init__(self, stream, engine, quiet=False, max_hits=None):
+        self.stream = stream
+        self.engine = engine
+        self.quiet = quiet
+        self.max_hits = max_hits
+
+    def note(self, message):
+        if not self.quiet:
+            print(message, file=sys.stderr)
+
+    def report_file(self, file_index, filepath, result, check_pointer):
+        write = self.stream.write
+        for record in iter_hit_records(filepath, self.engine, result.replacements, result.pointers, self.max_hits, result.findings, result.lines):
+            write(json.dumps(record, ensure_ascii=False))
+            write('\n')
 
-def process_matching_files(target_files, swaps, apply_changes, file_number=None, exclude_heading=None, exclude_pattern=None, check_pointer=False):
-    """处理所有匹配的文件"""
+    def report_error(self, file_index, filepath, message):
+        print(f"{YELLOW}跳过文件 [{file_index}]: {filepath}（{message}）{RESET}", file=sys.stderr)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        if self.stream.buffer is sys.__stdout__.buffer:
+            # 标准输出上的包装只解除关联，不关闭标准输出
+            self.stream.detach()
+        else:
+            self.stream.close()
+
+# SARIF报告：先写出文件头和规则表，结果逐条写出，结束时补上文件尾
+class SarifReporter(JsonlReporter):
+
+    def __init__(self, stream, engine, quiet=False, max_hits=None):
+        super().__init__(stream, engine, quiet, max_hits)
+        self.first_result = True
+        rules = [{'id': str(rule_id), 'name': src, 'shortDescription': {'text': f"{src} → {dest}"}}
+                 for rule_id, (src, dest) in enumerate(engine.swaps)]
+        rules.extend({'id': f"check{check_id}", 'name': engine.check_rule_text(check_id), 'shortDescription': {'text': '命名检查'}}
+                     for check_id in range(len(engine.check_rules)))
+        rules.append({'id': 'pointer', 'name': 'pointer', 'shortDescription': {'text': '指针定义'}})
+        header = json.dumps({
+            'version': '2.1.0',
+            '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+            'runs': [{'tool': {'driver': {'name': 'LuckChecker', 'rules': rules}},
+                      'columnKind': 'unicodeCodePoints', 'results': []}],
+        }, ensure_ascii=False)
+        # 在results数组的位置切开，结果逐条写在中间
+        self.footer = header[header.rindex('[]') + 1:]
+        stream.write(header[:header.rindex('[]') + 1])
+
+    def report_file(self, file_index, filepath, result, check_pointer):
+        write = self.stream.write
+        for record in iter_hit_records(filepath, self.engine, result.replacements, result.pointers, self.max_hits, result.findings, result.lines):
+            if record['category'] == 'swap':
+                message = f"{record['src']} 应替换为 {record['dest']}"
+                region = {'startLine': record['line'], 'startColumn': record['col'],
+                          'endColumn': record['col'] + len(record['src'])}
+            elif record['category'] == 'check':
+                message = f"{record['src']} 不符合命名规则 {self.engine.check_rule_text(int(record['rule'][5:]))}"
+                if record['type']:
+                    message += f"（声明类型 {record['type']}）"
+                region = {'startLine': record['line'], 'startColumn': record['col'],
+                          'endColumn': record['col'] + len(record['src'])}
+            else:
+                message = f"{record['category']}: {record['src']}"
+                region = {'startLine': record['line']}
+            sarif_result = {
+                'ruleId': str(record['rule']),
+                'level': 'note' if record['category'] not in ('swap', 'check') else 'warning',
+                'message': {'text': message},
+                'locations': [{'physicalLocation': {
+                    'artifactLocation': {'uri': filepath.replace(os.sep, '/')},
+                    'region': region}}],
+            }
+            write('' if self.first_result else ',')
+            write(json.dumps(sarif_result, ensure_ascii=False))
+            self.first_result = False
+
+    def close(self):
+        self.stream.write(self.footer)
+        self.stream.write('\n')
+        super().close()
+
+# 根据输出格式创建报告器
+def create_reporter(output_format, engine, quiet=False, output_path=None, max_hits=None):
+    if output_format == 'text':
+        return TextReporter(quiet, max_hits, engine)
+    # 带缓冲写出，不经过colorama：sys.stdout已被colorama.init()换成逐次转义的包装，直接写到原始标准输出的缓冲区
+    if output_path:
+        stream = open(output_path, 'w', encoding='utf-8', buffering=1024 * 1024)
+    else:
+        sys.stdout.flush()
+        stream = io.TextIOWrapper(sys.__stdout__.buffer, encoding='utf-8', write_through=False)
+    if output_format == 'sarif':
+        return SarifReporter(stream, engine, quiet, max_hits)
+    return JsonlReporter(stream, engine, quiet, max_hits)
+
+# 超过此大小的文件用mmap做预筛选，被筛掉的文件不需要整个读入内存
+PREFILTER_MMAP_SIZE = 1024 * 1024
+
+# 超过此大小的文件逐块流式处理，内存占用与文件大小无关
+STREAM_FILE_SIZE = 64 * 1024 * 1024
+# 流式处理时每块的行数；块在语句结束的行处截断，跨行的声明和指针定义尽量不被拆开
+STREAM_CHUNK_LINES = 65536
+
+# 单个文件的处理结果；timings为性能分析时该文件的PhaseTimer，未开启时为None；
+# stale_cache为True表示缓存结果与当前替换规则不一致，已重新扫描；error为文件无法读取或解码时的原因，此时其余字段为空
+ScanResult = namedtuple('ScanResult', ['lines', 'replacements', 'count', 'pointers', 'signature', 'prefiltered', 'findings', 'timings',
+                                       'stale_cache', 'error'], defaults=(None, False, None))
+
+# 单个文件内各阶段的计时
+class PhaseTimer:
+    """lap(阶段)结束当前阶段并开始下一阶段，记录 (阶段, 开始时间, 墙上时间, CPU时间)
+
+    开始时间取自perf_counter，与主进程可比，用于导出Chrome trace；可在工作进程中使用并随结果传回
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.laps = []
+        self.mark_wall = time.perf_counter()
+        self.mark_cpu = time.process_time()
+
+    def lap(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        self.laps.append((name, self.mark_wall, wall - self.mark_wall, cpu - self.mark_cpu))
+        self.mark_wall, self.mark_cpu = wall, cpu
+
+    def totals(self):
+        """返回 (总墙上时间, 总CPU时间)"""
+        return sum(lap[2] for lap in self.laps), sum(lap[3] for lap in self.laps)
+
+# 不做计时的PhaseTimer，未开启性能分析时使用
+class NullPhaseTimer:
+
+    def lap(self, name):
+        pass
+
+NULL_PHASE_TIMER = NullPhaseTimer()
+
+# 直接按字节处理的编码：ASCII字节只表示ASCII字符，多字节字符的每个字节都不小于0x80
+BYTE_ENCODING = 'utf-8'
+
+# 由BOM确定的编码，UTF-32 LE的BOM以UTF-16 LE的BOM开头，要先判断；BOM作为内容的一部分保留，写回时原样写出
+BOM_ENCODINGS = ((codecs.BOM_UTF32_LE, 'utf-32-le'), (codecs.BOM_UTF32_BE, 'utf-32-be'), (codecs.BOM_UTF8, BYTE_ENCODING),
+                 (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be'))
+
+# 由文件开头的字节判断BOM，没有BOM时返回None
+def bom_encoding(head):
+    for bom, encoding in BOM_ENCODINGS:
+        if head.startswith(bom):
+            return encoding
+    return None
+
+# 检测文件编码
+def detect_encoding(data, fallback_encoding=None):
+    """依次按BOM、UTF-8校验、备用编码确定编码，每个文件只检测一次；data可以是bytes或mmap，纯ASCII的bytes不需要解码校验。
+    不是合法的UTF-8又没有备用编码时，与以前一样抛出UnicodeDecodeError"""
+    encoding = bom_encoding(data[:4])
+    if encoding is not None:
+        return encoding
+    if isinstance(data, bytes) and data.isascii():
+        return BYTE_ENCODING
+    try:
+        codecs.utf_8_decode(data, 'strict', True)
+    except UnicodeDecodeError:
+        if fallback_encoding is None:
+            raise
+        return fallback_encoding
+    return BYTE_ENCODING
+
+# 原始字节上的匹配结果是否与解码后一致
+def byte_matching_reliable(data, fallback_encoding=None):
+    """UTF-8内容可以直接按字节匹配；没有备用编码时非UTF-8的文件反正不能处理，只需要看BOM"""
+    if fallback_encoding is None:
+        return bom_encoding(data[:4]) in (None, BYTE_ENCODING)
+    return detect_encoding(data, fallback_encoding) == BYTE_ENCODING
+
+# 把文件内容切分为行
+def decode_source(data, fallback_encoding=None):
+    """返回 (行列表, 编码)：UTF-8内容不解码，行为保留换行符的bytes；其余编码解码为str行，换行符同样保持原样。
+    两种情况下行都可以由encode_source原样还原为文件内容"""
+    encoding = detect_encoding(data, fallback_encoding)
+    if encoding == BYTE_ENCODING:
+        return data.splitlines(keepends=True), encoding
+    return io.StringIO(data.decode(encoding), newline='').readlines(), encoding
+
+# 把行还原为文件内容
+def encode_source(lines, encoding):
+    return b''.join(lines) if encoding == BYTE_ENCODING else ''.join(lines).encode(encoding)
+
+# 指针分析只处理文本，按字节处理的行在这里整体解码，结果与按通用换行规则读取的行一致
+def text_lines(lines):
+    if lines and isinstance(lines[0], bytes):
+        return io.StringIO(b''.join(lines).decode('utf-8', 'replace'), newline=None).readlines()
+    return lines
+
+# 计算文件签名 (大小, 修改时间, 内容哈希)
+def file_signature(st, data):
+    return (st.st_size, st.st_mtime_ns, hashlib.blake2b(data, digest_size=16).hexdigest())
+
+# 读取源文件，返回 (行列表, 文件签名, 编码)
+def read_source_file(filepath, engine=None, prefetched=None, fallback_encoding=None):
+    """按字节读取文件，签名为 (大小, 修改时间, 内容哈希)，再由decode_source切分为行列表
+
+    指定engine时先在原始字节上做预筛选，不包含任何替换源的文件不切分，行列表和编码返回None；
+    prefetched为FilePrefetcher已读入的 (文件状态, 内容) 时不再打开文件；指定engine时使用其备用编码
+    """
+    if engine is not None:
+        fallback_encoding = engine.fallback_encoding
+    if prefetched is not None:
+        st, data = prefetched
+        if engine is not None and not engine.may_match(data):
+            return None, file_signature(st, data), None
+        original_lines, encoding = decode_source(data, fallback_encoding)
+        return original_lines, file_signature(st, data), encoding
+
+    with open(filepath, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if engine is not None and st.st_size >= PREFILTER_MMAP_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if not engine.may_match(mm):
+                    return None, file_signature(st, mm), None
+            data = f.read()
+        else:
+            data = f.read()
+            if engine is not None and not engine.may_match(data):
+                return None, file_signature(st, data), None
+    original_lines, encoding = decode_source(data, fallback_encoding)
+    return original_lines, file_signature(st, data), encoding
+
+# 处理单个文件：读取、收集替换位置、检查指针，实际替换时直接写回
+def scan_file(filepath, engine, exclude_heading, exclude_pattern, check_pointer, apply_changes, stream_size=STREAM_FILE_SIZE,
+              cached=None, line_ranges=None, profile=False, prefetched=None, writer=None):
+    """处理单个文件，返回ScanResult，可在工作进程中执行
+
+    cached为该文件的缓存条目，内容哈希一致时直接复用其中的替换位置和指针定义；
+    line_ranges指定时只检查（和修改）这些行，格式见collect_replacements；
+    profile为True时记录各阶段的时间，放在结果的timings中；
+    不小于stream_size字节的文件交给scan_large_file流式处理（只检查改动行时除外）；
+    prefetched见read_source_file，writer为BackgroundWriter时修改后的内容交给它写回
+    """
+    timer = PhaseTimer() if profile else NULL_PHASE_TIMER
+    if prefetched is None and stream_size and line_ranges is None and os.path.getsize(filepath) >= stream_size:
+        return scan_large_file(filepath, engine, exclude_heading, exclude_pattern, check_pointer, apply_changes,
+                               cached, timer)._replace(timings=timer if profile else None)
+    original_lines, signature, encoding = read_source_file(filepath, engine, prefetched)
+    prefiltered = original_lines is None
+    timer.lap('read')
+
+    stale_cache = (cached is not None and cached['hash'] == signature[2] and apply_changes and cached['count']
+                   and (prefiltered or not spans_match_sources(original_lines, cached['replacements'], engine)))
+    if stale_cache:
+        # 缓存的替换位置与当前规则对不上，写回前重新扫描，不能按错误的目标修改文件；提示由主进程输出
+        cached = None
+
+    if cached is not None and cached['hash'] == signature[2]:
+        spans, count = cached['replacements'], cached['count']
+        pointer_definitions, findings = cached['pointers'], cached['findings']
+    elif prefiltered:
+        # 预筛选未发现任何替换源或检查对象，不需要逐行扫描
+        spans, count, findings = HitSpans(), 0, []
+        pointer_definitions = None
+    else:
+        # 收集替换位置和命名检查结果
+        spans, count, findings = collect_replacements(original_lines, engine, exclude_heading, exclude_pattern, line_ranges, timer)
+        pointer_definitions = None
+
+    # 只在需要检查指针时执行指针检查，直接使用已读入的内容
+    if check_pointer and pointer_definitions is None:
+        if prefiltered:
+            # 预筛选时没有切分，指针分析仍需要文件内容
+            original_lines, _, encoding = read_source_file(filepath, prefetched=prefetched, fallback_encoding=engine.fallback_encoding)
+        pointer_definitions = find_pointer_definitions(text_lines(original_lines))
+        if line_ranges is not None:
+            pointer_definitions = [definition for definition in pointer_definitions
+                                   if any(first < definition[0] <= last for first, last in line_ranges)]
+        timer.lap('pointers')
+
+    if prefiltered:
+        original_lines = []
+
+    # 实际替换阶段
+    if apply_changes and count > 0:
+        modified, modified_lines = apply_replacements(original_lines, spans, engine)
+        if modified:
+            # 按原编码写回，替换位置以外的字节（BOM、换行符）保持不变
+            data = encode_source(modified_lines, encoding)
+            if writer is not None:
+                writer.write(filepath, data)
+            else:
+                with open(filepath, 'wb') as f:
+                    f.write(data)
+        timer.lap('write')
+
+    return ScanResult(original_lines, spans, count, pointer_definitions, signature, prefiltered, findings,
+                      timer if profile else None, bool(stale_cache))
+
+# 处理单个文件，无法读取或解码时返回带error的结果
+def scan_file_or_skip(filepath, *args, **kwargs):
+    """与scan_file相同，但单个文件出错不中断整个运行，进程池中也一样；错误原因由主进程的报告器输出"""
+    try:
+        return scan_file(filepath, *args, **kwargs)
+    except UnicodeDecodeError as e:
+        error = f"不是合法的UTF-8，可用 Encoding = 指定备用编码（{e.reason}）"
+    except OSError as e:
+        error = e.strerror or str(e)
+    return ScanResult([], HitSpans(), 0, None, None, False, [], error=error)
+
+# 检查缓存的替换位置在当前内容中仍然是各自规则的源文本
+def spans_match_sources(original_lines, spans, engine):
+    """规则编号与源文本一一对应，源文本一致时替换目标也就与当前规则一致"""
+    sources = [src for src, _ in engine.swaps]
+    if original_lines and isinstance(original_lines[0], bytes):
+        sources = [src.encode('utf-8') for src in sources]
+    for line_idx, start, end, rule_id in zip(spans.lines, spans.starts, spans.ends, spans.rules):
+        if rule_id >= len(sources) or line_idx >= len(original_lines) or original_lines[line_idx][start:end] != sources[rule_id]:
+            return False
+    return True
+
+# 块可以在以这些字符结尾的行处截断
+CHUNK_END_MARKS = (';', '{', '}')
+CHUNK_END_BYTES = (b';', b'{', b'}')
+
+# 按块读取行
+def iter_line_chunks(f, chunk_lines=STREAM_CHUNK_LINES):
+    """依次产出 (块首行号, 行列表)，行号从0开始；凑够chunk_lines行后延续到以 ; { } 结尾的行为止，最多再读chunk_lines行"""
+    first_line = 0
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines and (line.rstrip()[-1:] in (CHUNK_END_BYTES if isinstance(line, bytes) else CHUNK_END_MARKS)
+                                          or len(chunk) >= 2 * chunk_lines):
+            yield first_line, chunk
+            first_line += len(chunk)
+            chunk = []
+    if chunk:
+        yield first_line, chunk
+
+# 读取时同时计算内容哈希的原始流
+class HashingReader(io.RawIOBase):
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.hash = hashlib.blake2b(digest_size=16)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        if size:
+            self.hash.update(memoryview(buffer)[:size])
+        return size
+
+# 分块计算文件内容哈希，结果与file_signature一致
+def hash_file_blocks(f, block_size=1024 * 1024):
+    content_hash = hashlib.blake2b(digest_size=16)
+    for block in iter(lambda: f.read(block_size), b''):
+        content_hash.update(block)
+    return content_hash.hexdigest()
+
+# 流式处理大文件
+def scan_large_file(filepath, engine, exclude_heading, exclude_pattern, check_pointer, apply_changes, cached=None, timer=NULL_PHASE_TIMER):
+    """与scan_file的结果相同，但不把整个文件读入内存
+
+    按块读取行，词法分析器的状态在块之间延续，内容哈希在读取的同时计算；不做字节预筛选，
+    预筛选要在整个文件上匹配，会把文件全部映射进内存。结果中的lines只保留有替换或检查结果的行
+    （{行号: 行内容}）。实际替换时修改后的内容逐块写入同目录下的临时文件，全部完成后再原子替换原文件。
+    编码先看BOM；没有BOM时按UTF-8逐块校验并按字节处理，遇到非UTF-8的块时从头按备用编码重新处理
+    """
+    raw = open(filepath, 'rb', buffering=0)
+    try:
+        st = os.fstat(raw.fileno())
+        # 有缓存条目时先分块计算哈希，内容未变化则不需要扫描
+        if cached is not None and not apply_changes and (cached['pointers'] is not None or not check_pointer):
+            content_hash = hash_file_blocks(raw)
+            timer.lap('read')
+            if cached['hash'] == content_hash:
+                return ScanResult(cached['lines'], cached['replacements'], cached['count'], cached['pointers'],
+                                  (st.st_size, st.st_mtime_ns, content_hash), cached['prefiltered'], cached['findings'])
+            raw.seek(0)
+
+        def scan_stream(encoding, validate):
+            raw.seek(0)
+            reader = HashingReader(raw)
+            lines = io.BufferedReader(reader)
+            if encoding != BYTE_ENCODING:
+                lines = io.TextIOWrapper(lines, encoding=encoding, newline='')
+            result = scan_line_chunks(filepath, lines, engine, exclude_heading, exclude_pattern, check_pointer, apply_changes,
+                                      timer, encoding, validate)
+            # 哈希在读完整个文件后才确定
+            return result._replace(signature=(st.st_size, st.st_mtime_ns, reader.hash.hexdigest()))
+
+        encoding = bom_encoding(raw.read(4))
+        if encoding is None or encoding == BYTE_ENCODING:
+            try:
+                return scan_stream(BYTE_ENCODING, encoding is None)
+            except UnicodeDecodeError:
+                if engine.fallback_encoding is None:
+                    raise
+                encoding = engine.fallback_encoding
+        return scan_stream(encoding, False)
+    finally:
+        raw.close()
+
+# 逐块扫描行，修改时写回
+def scan_line_chunks(filepath, lines, engine, exclude_heading, exclude_pattern, check_pointer, apply_changes, timer,
+                     encoding=BYTE_ENCODING, validate=False):
+    """返回ScanResult，signature留空由调用者填写
+
+    encoding为BYTE_ENCODING时lines产出bytes行，修改后的内容按字节写回；validate为True时逐块校验UTF-8，
+    不合法时抛出UnicodeDecodeError，临时文件随之删除
+    """
+    spans = HitSpans()
+    findings = []
+    pointer_definitions = [] if check_pointer else None
+    kept_lines = {}
+    count = 0
+    binary = encoding == BYTE_ENCODING
+    lexer = ByteCodeLexer() if binary else CodeLexer()
+    # 指针分析在解码后的文本上进行
+    pointer_lexer = CodeLexer()
+    output = None
+    if apply_changes:
+        output = tempfile.NamedTemporaryFile('wb' if binary else 'w', encoding=None if binary else encoding, newline=None if binary else '',
+                                             dir=os.path.dirname(os.path.abspath(filepath)),
+                                             prefix=f".{os.path.basename(filepath)}.", suffix='.tmp', delete=False)
+    try:
+        for first_line, chunk in iter_line_chunks(lines):
+            if validate:
+                data = b''.join(chunk)
+                if not data.isascii():
+                    codecs.utf_8_decode(data, 'strict', True)
+            timer.lap('read')
+            chunk_spans, chunk_count, chunk_findings = collect_replacements(chunk, engine, exclude_heading, exclude_pattern,
+                                                                            timer=timer, lexer=lexer)
+            count += chunk_count
+            spans.extend(chunk_spans, first_line)
+            for line_idx in chunk_spans.line_indices():
+                kept_lines[first_line + line_idx] = chunk[line_idx]
+            for line_idx, *finding in chunk_findings:
+                findings.append((first_line + line_idx, *finding))
+                kept_lines[first_line + line_idx] = chunk[line_idx]
+            if check_pointer:
+                pointer_definitions.extend((first_line + line_number, *definition)
+                                           for line_number, *definition in find_pointer_definitions(text_lines(chunk), pointer_lexer))
+                timer.lap('pointers')
+            if output is not None:
+                output.writelines(apply_replacements(chunk, chunk_spans, engine)[1] if chunk_spans else chunk)
+                timer.lap('write')
+
+        if output is not None:
+            output.close()
+            if count > 0:
+                shutil.copymode(filepath, output.name)
+                os.replace(output.name, filepath)
+            else:
+                os.unlink(output.name)
+            timer.lap('write')
+    except BaseException:
+        if output is not None:
+            output.close()
+            os.unlink(output.name)
+        raise
+
+    return ScanResult(kept_lines, spans, count, pointer_definitions, None, False, findings)
+
+# 计算规则集哈希，任何替换规则、排除规则或检查规则的变化都会使缓存失效
+def compute_rules_hash(swaps, exclude_heading, exclude_pattern, check_rules, fallback_encoding=None):
+    """返回规则集的哈希值；备用编码决定了哪些文件能被解码，也计入其中"""
+    rules = repr((RESULT_CACHE_VERSION, swaps, exclude_heading, exclude_pattern, check_rules, fallback_encoding))
+    return hashlib.blake2b(rules.encode('utf-8'), digest_size=16).hexdigest()
+
+# 结果缓存格式版本，扫描逻辑变化时递增
+RESULT_CACHE_VERSION = 9
+
+# 增量结果缓存
+class ResultCache:
+    """按文件保存替换位置和指针定义，文件和规则都未变化时直接复用上次的结果
+
+    条目以绝对路径为键，记录文件大小、修改时间和内容哈希；规则集哈希（含缓存格式版本）不同则整个缓存作废。
+    例外是只新增了替换规则：rules为 (替换规则, 排除前置标记, 排除模式, 检查规则, 备用编码)，
+    配合标识符索引只作废可能出现新规则源文本的文件，其余文件的结果仍然有效。
+    替换规则按SwapEngine中的顺序排列，条目里的规则编号是其下标；新增规则会改变排序，沿用的条目按源文本换算成新编号
+    """
+
+    def __init__(self, cache_dir, rules_hash, max_bytes, rules=None, index=None):
+        self.cache_path = os.path.join(cache_dir, 'results.pickle')
+        self.rules_hash = rules_hash
+        self.rules = rules
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        # 新增规则后保留下来的条目数，None表示规则没有变化或缓存整体作废
+        self.kept_after_rule_change = None
+
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('rules_hash') == rules_hash:
+                self.entries = data['entries']
+            elif index is not None and rules is not None and data.get('rules') is not None and data.get('version') == RESULT_CACHE_VERSION:
+                added_sources = self.added_sources(data['rules'], rules)
+                if added_sources is not None:
+                    rule_map = self.rule_id_map(data['rules'][0], rules[0])
+                    for path, entry in data['entries'].items():
+                        # 规则编号超出旧规则列表的条目无法换算，一并作废
+                        if max(entry['replacements'].rules, default=-1) < len(rule_map) and not index.may_contain(path, added_sources):
+                            entry['replacements'] = entry['replacements'].remap_rules(rule_map)
+                            self.entries[path] = entry
+                    self.kept_after_rule_change = len(self.entries)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"{YELLOW}缓存文件损坏，已忽略: {str(e)}{RESET}")
+
+    @staticmethod
+    def added_sources(old_rules, new_rules):
+        """新规则集只是在旧规则集上新增了替换规则时，返回新增规则的源文本列表，否则返回None
+
+        沿用的条目只依赖文件内容和命中的规则，条目中的规则编号要能换算成新编号：旧规则必须互不重复且全部保留
+        """
+        old_swaps, *old_rest = old_rules
+        new_swaps, *new_rest = new_rules
+        if old_rest != new_rest or len(set(old_swaps)) != len(old_swaps) or not set(old_swaps) <= set(new_swaps):
+            return None
+        return [src for src, _ in set(new_swaps) - set(old_swaps)]
+
+    @staticmethod
+    def rule_id_map(old_swaps, new_swaps):
+        """旧规则编号 → 新规则编号，两个列表都按SwapEngine中的顺序排列"""
+        new_ids = {swap: rule_id for rule_id, swap in enumerate(new_swaps)}
+        return [new_ids[swap] for swap in old_swaps]
+
+    def lookup(self, filepath):
+        """返回文件的缓存条目，以及文件大小和修改时间是否与条目一致"""
+        entry = self.entries.get(os.path.abspath(filepath))
+        if entry is None:
+            return None, False
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None, False
+        return entry, (entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns)
+
+    def store(self, filepath, original_lines, spans, count, pointer_definitions, signature, prefiltered=False, findings=()):
+        """记录文件的处理结果，只保存有替换或检查结果的行内容用于显示"""
+        size, mtime, content_hash = signature
+        self.entries[os.path.abspath(filepath)] = {
+            'size': size,
+            'mtime': mtime,
+            'hash': content_hash,
+            'replacements': spans,
+            'count': count,
+            'pointers': pointer_definitions,
+            'findings': findings,
+            'lines': {line_idx: original_lines[line_idx]
+                      for line_idx in chain(spans.line_indices(), (finding[0] for finding in findings))},
+            'prefiltered': prefiltered,
+            'used': time.time(),
+        }
+
+    def touch(self, filepath):
+        """标记条目最近被使用"""
+        self.entries[os.path.abspath(filepath)]['used'] = time.time()
+
+    def discard(self, filepath):
+        """删除文件的条目（文件已被改写）"""
+        self.entries.pop(os.path.abspath(filepath), None)
+
+    def save(self):
+        """清理已删除文件的条目，按大小上限淘汰最久未使用的条目后写回磁盘"""
+        self.entries = {path: entry for path, entry in self.entries.items() if os.path.exists(path)}
+
+        data = pickle.dumps({'version': RESULT_CACHE_VERSION, 'rules_hash': self.rules_hash, 'rules': self.rules, 'entries': self.entries}, protocol=pickle.HIGHEST_PROTOCOL)
+        while len(data) > self.max_bytes and self.entries:
+            # 超过大小上限时，每次淘汰最久未使用的一半条目
+            by_age = sorted(self.entries, key=lambda path: self.entries[path]['used'])
+            for path in by_age[:max(1, len(by_age) // 2)]:
+                del self.entries[path]
+            data = pickle.dumps({'version': RESULT_CACHE_VERSION, 'rules_hash': self.rules_hash, 'rules': self.rules, 'entries': self.entries}, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.cache_path)
+
+# 标识符，只取ASCII字符，与替换规则的单词边界一致
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+IDENTIFIER_BYTES = re.compile(IDENTIFIER.pattern.encode('ascii'))
+
+# 统计代码中每个标识符出现的行
+def index_identifiers(original_lines):
+    """返回 {标识符: 行号元组}，行号从1开始；字符串和注释中的标识符不计入。original_lines可以是bytes行"""
+    occurrences = {}
+    if original_lines and isinstance(original_lines[0], bytes):
+        masked_lines = mask_literals(b''.join(original_lines)).split(b'\n')
+        find_tokens = lambda line: [token.decode('ascii') for token in set(IDENTIFIER_BYTES.findall(line))]
+    else:
+        masked_lines = mask_literals(''.join(original_lines)).split('\n')
+        find_tokens = lambda line: set(IDENTIFIER.findall(line))
+    for line_number, line in enumerate(masked_lines, 1):
+        for token in find_tokens(line):
+            lines = occurrences.get(token)
+            if lines is None:
+                occurrences[token] = [line_number]
+            else:
+                lines.append(line_number)
+    return {token: tuple(lines) for token, lines in occurrences.items()}
+
+# 源文本中的标识符，文件中必须全部出现该规则才可能命中
+def source_identifiers(src):
+    return IDENTIFIER.findall(src)
+
+# 标识符倒排索引
+class IdentifierIndex:
+    """标识符 → {文件绝对路径: 行号元组}，保存在缓存目录中
+
+    按文件大小、修改时间和内容哈希增量更新，只重新索引内容变化的文件。
+    新增替换规则时据此找出可能命中的文件，--query 也直接从这里回答；fallback_encoding见decode_source
+    """
+
+    def __init__(self, cache_dir, fallback_encoding=None):
+        self.index_path = os.path.join(cache_dir, 'index.pickle')
+        self.fallback_encoding = fallback_encoding
+        # 文件绝对路径 → (大小, 修改时间, 内容哈希, 标识符元组)
+        self.files = {}
+        self.postings = {}
+        self.dirty = False
+        self.updated = 0
+
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == RESULT_CACHE_VERSION:
+                self.files = data['files']
+                self.postings = data['postings']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"{YELLOW}索引文件损坏，已忽略: {str(e)}{RESET}")
+
+    def update(self, target_files):
+        """更新目标文件的索引，并去掉不再是目标文件的条目"""
+        current = set()
+        for filepath in target_files:
+            abs_path = os.path.abspath(filepath)
+            current.add(abs_path)
+            try:
+                self.update_file(abs_path)
+            except (OSError, UnicodeDecodeError):
+                # 无法读取的文件不进入索引，新增规则时按可能命中处理
+                self.remove_file(abs_path)
+        for abs_path in self.files.keys() - current:
+            self.remove_file(abs_path)
+
+    def update_file(self, abs_path):
+        st = os.stat(abs_path)
+        entry = self.files.get(abs_path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return
+
+        with open(abs_path, 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if entry is not None and entry[2] == content_hash:
+            # 只是被touch过，标识符不变
+            self.files[abs_path] = (st.st_size, st.st_mtime_ns, content_hash, entry[3])
+            self.dirty = True
+            return
+
+        occurrences = index_identifiers(decode_source(data, self.fallback_encoding)[0])
+        self.remove_file(abs_path)
+        for token, lines in occurrences.items():
+            self.postings.setdefault(token, {})[abs_path] = lines
+        self.files[abs_path] = (st.st_size, st.st_mtime_ns, content_hash, tuple(occurrences))
+        self.updated += 1
+        self.dirty = True
+
+    def remove_file(self, abs_path):
+        entry = self.files.pop(abs_path, None)
+        if entry is None:
+            return
+        for token in entry[3]:
+            files = self.postings.get(token)
+            if files is not None:
+                files.pop(abs_path, None)
+                if not files:
+                    del self.postings[token]
+        self.dirty = True
+
+    def lookup(self, tokens):
+        """返回 {文件绝对路径: 行号列表}，这些行中同时出现了所有标识符"""
+        if not tokens:
+            return {}
+        result = None
+        for token in tokens:
+            files = self.postings.get(token, {})
+            if result is None:
+                result = {path: set(lines) for path, lines in files.items()}
+            else:
+                result = {path: lines & set(files[path]) for path, lines in result.items() if path in files}
+            result = {path: lines for path, lines in result.items() if lines}
+        return {path: sorted(lines) for path, lines in result.items()}
+
+    def may_contain(self, abs_path, sources):
+        """文件中是否可能出现任一源文本；不在索引中的文件或没有标识符的源文本都按可能出现处理"""
+        entry = self.files.get(abs_path)
+        if entry is None:
+            return True
+        for src in sources:
+            tokens = source_identifiers(src)
+            if not tokens or all(abs_path in self.postings.get(token, ()) for token in tokens):
+                return True
+        return False
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump({'version': RESULT_CACHE_VERSION, 'files': self.files, 'postings': self.postings},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.index_path)
+        self.dirty = False
+
+# 从标识符索引中查询并输出
+def query_identifiers(query, cache_dir, target_files, fallback_encoding=None):
+    tokens = source_identifiers(query)
+    if not tokens:
+        print_error("查询内容中没有标识符", None, None, query)
+        return
+    index = IdentifierIndex(cache_dir, fallback_encoding)
+    index.update(target_files)
+    index.save()
+
+    # 以命令行上的路径显示
+    display_paths = {os.path.abspath(path): path for path in target_files}
+    found = index.lookup(tokens)
+    for abs_path in sorted(found, key=lambda path: display_paths.get(path, path)):
+        lines = found[abs_path]
+        print(f"{CYAN}{display_paths.get(abs_path, abs_path)}{RESET}: {', '.join(map(str, lines))}")
+    print(f"\n{GREEN}{' '.join(tokens)}: {sum(len(lines) for lines in found.values())} 行，{len(found)} 个文件"
+          f"（索引 {len(index.files)} 个文件，本次更新 {index.updated} 个）{RESET}")
+
+# 预读和后台写回共用的缓冲上限
+IO_BUFFER_SIZE = 32 * 1024 * 1024
+
+# 文件预读
+class FilePrefetcher:
+    """用几个读取线程按顺序预读文件的原始字节，扫描线程按同样的顺序取走
+
+    已读入但未取走的字节数不超过max_bytes（下一个要取走的文件除外，避免大文件卡住流水线）；
+    大于max_file_size的文件和读取失败的文件不预读，get返回None，由scan_file自己读取并照常报错
+    """
+
+    def __init__(self, paths, threads, max_bytes, max_file_size):
+        self.paths = paths
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.condition = threading.Condition()
+        # 序号 → ((文件状态, 内容) 或 None, 占用的字节数)
+        self.results = {}
+        self.buffered = 0
+        self.next_index = 0
+        self.consumed = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(min(threads, len(paths)))]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.closed or self.next_index >= len(self.paths):
+                    return
+                index = self.next_index
+                self.next_index += 1
+            item, size = self.read(index)
+            with self.condition:
+                self.results[index] = (item, size)
+                self.condition.notify_all()
+
+    def read(self, index):
+        try:
+            with open(self.paths[index], 'rb') as f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                if size > self.max_file_size:
+                    return None, 0
+                with self.condition:
+                    while (not self.closed and index != self.consumed
+                           and self.buffered > 0 and self.buffered + size > self.max_bytes):
+                        self.condition.wait()
+                    if self.closed:
+                        return None, 0
+                    self.buffered += size
+                try:
+                    return (st, f.read()), size
+                except OSError:
+                    return None, size
+        except OSError:
+            return None, 0
+
+    def get(self, index):
+        """按顺序取走第index个文件的 (文件状态, 内容)，未预读时返回None"""
+        with self.condition:
+            while index not in self.results:
+                self.condition.wait()
+            item, size = self.results.pop(index)
+            self.buffered -= size
+            self.consumed = index + 1
+            self.condition.notify_all()
+        return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+# 后台写回
+class BackgroundWriter:
+    """在后台线程中按提交顺序写回修改后的文件，排队中的内容不超过max_bytes（单个超过上限的文件除外）
+
+    写回失败时记录第一个错误，之后的提交和close都会抛出该错误
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.queue = []
+        self.queued_bytes = 0
+        self.finished = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, filepath, data):
+        size = len(data)
+        with self.condition:
+            while self.error is None and self.queued_bytes > 0 and self.queued_bytes + size > self.max_bytes:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.queue.append((filepath, data, size))
+            self.queued_bytes += size
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.finished:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                filepath, data, size = self.queue.pop(0)
+            try:
+                if self.error is None:
+                    with open(filepath, 'wb') as f:
+                        f.write(data)
+            except OSError as e:
+                self.error = e
+            with self.condition:
+                self.queued_bytes -= size
+                self.condition.notify_all()
+
+    def close(self):
+        """等待所有排队的文件写完"""
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+# 工作进程共享的扫描参数，由进程池初始化函数设置，避免每个任务重复传递引擎
+_worker_args = None
+
+def _init_scan_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+def _scan_file_in_worker(task):
+    filepath, cached, line_ranges, profile = task
+    return scan_file_or_skip(filepath, *_worker_args, cached=cached, line_ranges=line_ranges, profile=profile)
+
+# 按文件顺序产出处理结果
+def iter_scan_results(indexed_files, scan_args, jobs=1, cache=None, changed_lines=None, profile=False, prefetch=0, writer=None):
+    """依次产出 (序号, 文件路径, 处理结果)；jobs大于1时使用进程池并行处理，结果仍保持原有顺序
+
+    changed_lines为 {文件路径: 行范围列表}，指定时每个文件只检查其中的行，此时不使用缓存；
+    profile为True时每个重新扫描的文件都记录各阶段的时间；
+    不使用进程池时，prefetch大于0则用这么多个线程预读后面的文件，writer为BackgroundWriter时在后台写回
+    """
+    line_ranges_of = (changed_lines or {}).get
+    check_pointer, apply_changes = scan_args[3], scan_args[4]
+
+    # 预览模式下文件大小和修改时间都未变化时无需读取文件，直接使用缓存的结果；
+    # 其余文件交给scan_file，已有条目随任务一起传递，内容哈希一致时同样复用
+    tasks = []
+    for file_index, filepath in indexed_files:
+        cached, unchanged = cache.lookup(filepath) if cache is not None else (None, False)
+        served = (unchanged and not apply_changes
+                  and (cached['pointers'] is not None or not check_pointer))
+        tasks.append((file_index, filepath, cached, served))
+
+    pending = [(filepath, cached, line_ranges_of(filepath), profile) for _, filepath, cached, served in tasks if not served]
+    executor = None
+    prefetcher = None
+    if (jobs <= 1 or len(pending) <= 1) and prefetch > 0 and len(pending) > 1:
+        # 读取线程提前把文件读入内存，扫描时不再等待文件系统；流式处理的大文件仍由scan_file自己读取
+        stream_size = scan_args[5] or IO_BUFFER_SIZE + 1
+        prefetcher = FilePrefetcher([filepath for filepath, *_ in pending], prefetch, IO_BUFFER_SIZE, min(IO_BUFFER_SIZE, stream_size - 1))
+        results = (scan_file_or_skip(filepath, *scan_args, cached=cached, line_ranges=line_ranges, profile=profile,
+                                     prefetched=prefetcher.get(index), writer=writer)
+                   for index, (filepath, cached, line_ranges, profile) in enumerate(pending))
+    elif jobs <= 1 or len(pending) <= 1:
+        results = (scan_file_or_skip(filepath, *scan_args, cached=cached, line_ranges=line_ranges, profile=profile, writer=writer)
+                   for filepath, cached, line_ranges, profile in pending)
+    else:
+        # 每个任务批量处理若干文件，减少进程间通信次数
+        chunksize = max(1, len(pending) // (jobs * 8))
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_scan_worker, initargs=scan_args)
+        # map按提交顺序返回结果，保证输出和日志顺序与文件列表一致
+        results = executor.map(_scan_file_in_worker, pending, chunksize=chunksize)
+
+    try:
+        for file_index, filepath, cached, served in tasks:
+            if served:
+                cache.hits += 1
+                cache.touch(filepath)
+                signature = (cached['size'], cached['mtime'], cached['hash'])
+                yield file_index, filepath, ScanResult(cached['lines'], cached['replacements'], cached['count'], cached['pointers'], signature, cached['prefiltered'], cached['findings'])
+                continue
+
+            result = next(results)
+            if cache is not None and result.error is not None:
+                # 出错的文件不缓存，已有条目也作废
+                cache.discard(filepath)
+            elif cache is not None:
+                if cached is not None and cached['hash'] == result.signature[2]:
+                    cache.hits += 1
+                else:
+                    cache.misses += 1
+                if apply_changes and result.count > 0:
+                    # 文件已被改写，旧的签名和替换位置都不再有效
+                    cache.discard(filepath)
+                else:
+                    cache.store(filepath, result.lines, result.replacements, result.count, result.pointers, result.signature,
+                                result.prefiltered, result.findings)
+            yield file_index, filepath, result
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if prefetcher is not None:
+            prefetcher.close()
+
+def process_matching_files(target_files, engine, apply_changes, file_number=None, exclude_heading=None, exclude_pattern=None, check_pointer=False, jobs=1, cache=None, reporter=None, changed_lines=None, profiler=None, stream_size=STREAM_FILE_SIZE, prefetch=0):
+    """处理所有匹配的文件；changed_lines见iter_scan_results，profiler为Profiler时记录各阶段和每个文件的时间，
+    不小于stream_size字节的文件流式处理；prefetch大于0且不使用进程池时，读取和写回都在后台线程中进行"""
     total = 0
     processed_files = 0
-    current_file_index = 0
+    prefiltered_files = 0
+    skipped_files = 0
+    if reporter is None:
+        reporter = TextReporter(engine=engine)
+    phase = profiler.phase if profiler is not None else lambda name: contextlib.nullcontext()
+
+    # 序号与collect_target_files打印的列表一致，-y N 只处理对应序号的文件
+    indexed_files = list(enumerate(target_files, 1))
+    if file_number is not None:
+        indexed_files = [(index, filepath) for index, filepath in indexed_files if index == file_number]
 
     # 创建日志文件
     log_file = None
@@ -747,59 +2620,53 @@ def process_matching_files(target_files, swaps, apply_changes, file_number=None,
         log_file.write(f"替换操作日志 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
         log_file.write(f"{'='*80}\n\n")
 
+    # 后台写回：扫描下一个文件时不必等待上一个文件写完
+    writer = BackgroundWriter(IO_BUFFER_SIZE) if apply_changes and prefetch > 0 and jobs <= 1 else None
+
     try:
+        scan_args = (engine, exclude_heading, exclude_pattern, check_pointer, apply_changes, stream_size)
         # 处理文件列表
-        for filepath in target_files:
-            current_file_index += 1
-            # 如果指定了文件序号且当前文件不是目标文件，则跳过
-            if file_number is not None and current_file_index != file_number:
+        for current_file_index, filepath, result in iter_scan_results(indexed_files, scan_args, jobs, cache, changed_lines, profiler is not None, prefetch, writer):
+            if result.error is not None:
+                # 无法读取或解码的文件跳过，继续处理其余文件
+                skipped_files += 1
+                reporter.report_error(current_file_index, filepath, result.error)
                 continue
-
-            abs_path = os.path.abspath(filepath)
-            separator = "-" * 120
-            print(f"{YELLOW}{separator}{RESET}")
-            print(f"{YELLOW}处理文件 [{current_file_index}]: {abs_path}{RESET}")
-            print(f"{YELLOW}{separator}{RESET}")
-
-            # 读取文件内容
-            with open(filepath, 'r', encoding='utf-8') as f:
-                original_lines = f.readlines()
-
-            # 收集替换位置
-            replacements_by_line, count = collect_replacements(original_lines, swaps, exclude_heading, exclude_pattern)
-            total += count
+            total += result.count
             processed_files += 1
+            prefiltered_files += result.prefiltered
+            if result.stale_cache:
+                # 写到stderr，不混入机器可读格式的输出
+                print(f"{YELLOW}缓存结果与当前替换规则不一致，已重新扫描: {filepath}{RESET}", file=sys.stderr)
+            engine.count_matches(result.replacements)
+            engine.count_findings(result.findings)
+            if profiler is not None:
+                profiler.add_file(filepath, result, engine)
+
+            # 显示替换位置和指针定义
+            with phase('report'):
+                reporter.report_file(current_file_index, filepath, result, check_pointer)
+
+            # 记录修改到日志文件（文件已在scan_file中写回）
+            if log_file and result.count > 0:
+                with phase('log'):
+                    log_changes(filepath, result.replacements, result.lines, log_file, engine)
+
+        # 等待后台写回全部完成，写回失败时照常抛出
+        if writer is not None:
+            with phase('write_wait'):
+                writer.close()
 
-            # 显示替换位置
-            display_replacements(filepath, replacements_by_line)
-
-            # 如果没有找到替换项目，显示提示信息
-            if count == 0:
-                print(f"{GRAY}没有查找到可替换项目{RESET}")
-
-            # 只在需要检查指针时执行指针检查
-            if check_pointer:
-                pointer_definitions = find_pointer_definitions(filepath)
-                display_pointer_definitions(filepath, pointer_definitions)
-
-            # 实际替换阶段
-            if apply_changes and count > 0:
-                modified, modified_lines = apply_replacements(original_lines, swaps)
-
-                if modified:
-                    # 记录修改到日志文件
-                    if log_file:
-                        log_changes(filepath, replacements_by_line, original_lines, log_file)
-
-                    # 写入修改后的内容
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.writelines(modified_lines)
+    finally:
+        if writer is not None and writer.thread.is_alive():
+            try:
+                writer.close()
+            except OSError:
+                pass
 
-            # 如果指定了文件序号且已处理完目标文件，则提前结束
-            if file_number is not None and current_file_index == file_number:
-                break
+        # 报告器由调用者关闭，监视模式下同一个报告器会被多次使用
+        reporter.flush()
 
-    finally:
         # 在日志文件末尾添加替换总数
         if log_file:
             log_file.write(f"\n{'='*80}\n")
@@ -807,22 +2674,306 @@ def process_matching_files(target_files, swaps, apply_changes, file_number=None,
             log_file.write(f"处理文件数: {processed_files}\n")
             log_file.write(f"{'='*80}\n")
             log_file.close()
-            print(f"\n{GREEN}修改日志已保存到: {log_filename}{RESET}")
+            reporter.note(f"\n{GREEN}修改日志已保存到: {log_filename}{RESET}")
+
+        if prefiltered_files:
+            reporter.note(f"{GRAY}预筛选跳过 {prefiltered_files} 个不含任何替换源的文件{RESET}")
+        if skipped_files:
+            reporter.note(f"{YELLOW}跳过 {skipped_files} 个无法读取或解码的文件{RESET}")
+
+        if cache is not None:
+            with phase('cache_save'):
+                cache.save()
+            reporter.note(f"{GRAY}缓存命中 {cache.hits} 个文件，重新扫描 {cache.misses} 个文件{RESET}")
 
     return total, processed_files
 
+# 性能分析时按规则逐条扫描的内容上限，超过后的文件不再逐条扫描，避免分析本身占用太多时间
+PROFILE_RULE_SAMPLE_BYTES = 256 * 1024
+
+# 文件内各阶段的中文名称，用于性能分析汇总
+FILE_PHASE_NAMES = {
+    'read': '读取', 'lex': '词法分析', 'match': '匹配和排除检查', 'check': '命名检查',
+    'pointers': '指针分析', 'write': '写回',
+}
+
+# 性能分析
+class Profiler:
+    """记录各阶段和每个文件的墙上时间、CPU时间，以及每条替换规则的命中次数和单独扫描时间
+
+    单独扫描时间是把每条规则单独编译后在前PROFILE_RULE_SAMPLE_BYTES的已解码内容上再扫描一遍测得的，
+    只用于比较规则之间的开销；实际扫描使用合并后的正则，不会从未命中的规则上节省这部分时间
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        # 阶段 → [墙上时间, CPU时间, 次数]，按首次出现的顺序排列
+        self.phases = {}
+        # 正在进行的阶段，每层记录其中内层阶段的 [墙上时间, CPU时间]
+        self.open_phases = []
+        self.file_phases = {}
+        # (文件路径, 墙上时间, CPU时间, {阶段: 墙上时间})
+        self.files = []
+        # Chrome trace事件：(名称, 分类, 进程号, 开始时间, 持续时间)
+        self.events = []
+        self.rule_patterns = None
+        self.rule_times = None
+        self.scanned_bytes = 0
+
+    def add_time(self, table, name, wall, cpu):
+        entry = table.setdefault(name, [0.0, 0.0, 0])
+        entry[0] += wall
+        entry[1] += cpu
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """主进程中的一个阶段，同名阶段的时间累加；汇总时按阶段开始的顺序排列
+
+        阶段可以嵌套，内层阶段的时间从外层阶段中扣除，各阶段的时间合计不超过总的墙上时间
+        """
+        self.phases.setdefault(name, [0.0, 0.0, 0])
+        nested = [0.0, 0.0]
+        self.open_phases.append(nested)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            self.open_phases.pop()
+            if self.open_phases:
+                self.open_phases[-1][0] += wall
+                self.open_phases[-1][1] += cpu
+            self.add_time(self.phases, name, wall - nested[0], cpu - nested[1])
+            self.events.append((name, 'phase', os.getpid(), start_wall, wall))
+
+    def add_file(self, filepath, result, engine):
+        """记录一个文件的处理时间；直接使用缓存结果的文件没有计时，不计入"""
+        timer = result.timings
+        if timer is None:
+            return
+        for name, start, wall, cpu in timer.laps:
+            self.add_time(self.file_phases, name, wall, cpu)
+            self.events.append((name, filepath, timer.pid, start, wall))
+        wall, cpu = timer.totals()
+        self.files.append((filepath, wall, cpu, {name: lap_wall for name, _, lap_wall, _ in timer.laps}))
+
+        # 已解码的文件再按规则逐条扫描一遍，预筛选跳过的文件没有内容
+        if result.prefiltered or not result.lines or self.scanned_bytes >= PROFILE_RULE_SAMPLE_BYTES:
+            return
+        with self.phase('rule_timing'):
+            if self.rule_patterns is None:
+                self.rule_patterns = [engine.single_rule_pattern(rule_id) for rule_id in range(len(engine.swaps))]
+                self.rule_times = [0.0] * len(engine.swaps)
+            # 流式处理的文件只保留了部分行（{行号: 行内容}）；按字节处理的行解码后再扫描，
+            # 只取到剩余的额度为止，大文件不会整个逐条扫描
+            lines = result.lines.values() if isinstance(result.lines, dict) else result.lines
+            budget = PROFILE_RULE_SAMPLE_BYTES - self.scanned_bytes
+            sample = []
+            for line in lines:
+                line = decode_line(line)[:budget]
+                sample.append(line)
+                budget -= len(line)
+                if budget <= 0:
+                    break
+            text = ''.join(sample)
+            self.scanned_bytes += len(text)
+            for rule_id, pattern in enumerate(self.rule_patterns):
+                start_time = time.perf_counter()
+                for _ in pattern.finditer(text):
+                    pass
+                self.rule_times[rule_id] += time.perf_counter() - start_time
+
+    def rule_records(self, engine):
+        """每条规则的 (源, 目标, 命中次数, 单独扫描时间)"""
+        rule_times = self.rule_times or [0.0] * len(engine.swaps)
+        return [(src, dest, count, rule_times[rule_id])
+                for rule_id, (src, dest, count) in enumerate(engine.rule_stats())]
+
+    def report(self, engine, top=10, file=None):
+        """输出汇总：各阶段时间、最慢的文件、开销最大的规则和从未命中的规则"""
+        print(f"\n{CYAN}===== 性能分析 ====={RESET}", file=file)
+        print(f"阶段{' ' * 14}    墙上时间     CPU时间    次数", file=file)
+        for name, (wall, cpu, calls) in self.phases.items():
+            print(f"{name:<18}{wall * 1000:>10.1f}ms{cpu * 1000:>10.1f}ms{calls:>8}", file=file)
+        print(f"{GRAY}嵌套的阶段（如process中的rule_timing、report）只计入自身，不重复计入外层阶段{RESET}", file=file)
+        if self.file_phases:
+            print(f"{GRAY}以下为各文件内的阶段合计（-j大于1时在工作进程中并行执行）{RESET}", file=file)
+            for name, (wall, cpu, calls) in self.file_phases.items():
+                print(f"  {name:<16}{wall * 1000:>10.1f}ms{cpu * 1000:>10.1f}ms{calls:>8}  {GRAY}{FILE_PHASE_NAMES.get(name, name)}{RESET}", file=file)
+        if engine is not None and engine.compile_time:
+            print(f"{GRAY}规则正则编译 {engine.compile_time * 1000:.1f}ms{RESET}", file=file)
+
+        if self.files:
+            print(f"\n{CYAN}最慢的 {min(top, len(self.files))} 个文件{RESET}", file=file)
+            for filepath, wall, cpu, laps in sorted(self.files, key=lambda item: item[1], reverse=True)[:top]:
+                slowest = max(laps, key=laps.get)
+                print(f"{wall * 1000:>10.1f}ms  CPU {cpu * 1000:>8.1f}ms  {filepath} {GRAY}（{FILE_PHASE_NAMES.get(slowest, slowest)}占 {laps[slowest] * 1000:.1f}ms）{RESET}", file=file)
+
+        if engine is None:
+            return
+        records = self.rule_records(engine)
+        if self.rule_times is not None:
+            print(f"\n{CYAN}单独扫描开销最大的 {min(top, len(records))} 条规则{RESET}"
+                  f"{GRAY}（在 {self.scanned_bytes / 1024 / 1024:.1f} MB 已解码内容上逐条扫描）{RESET}", file=file)
+            for src, dest, count, seconds in sorted(records, key=lambda item: item[3], reverse=True)[:top]:
+                print(f"{seconds * 1000:>10.3f}ms  {count:>8} 次  {src} → {dest}", file=file)
+        dead_rules = [src for src, _, count, _ in records if count == 0]
+        if dead_rules:
+            print(f"\n{YELLOW}从未命中的规则 {len(dead_rules)} 条，仍参与每个文件的扫描: {RESET}{', '.join(dead_rules)}", file=file)
+
+    def export(self, path, engine, trace_format='json'):
+        """trace_format为json时导出汇总数据，为chrome时导出Chrome trace（chrome://tracing、Perfetto可直接打开）"""
+        if trace_format == 'chrome':
+            data = {'traceEvents': [
+                {'name': name, 'cat': category if category == 'phase' else 'file', 'ph': 'X', 'pid': pid, 'tid': pid,
+                 'ts': round((start - self.origin) * 1e6), 'dur': round(wall * 1e6),
+                 'args': {} if category == 'phase' else {'file': category}}
+                for name, category, pid, start, wall in self.events], 'displayTimeUnit': 'ms'}
+        else:
+            table = lambda phases: {name: {'wall': wall, 'cpu': cpu, 'calls': calls} for name, (wall, cpu, calls) in phases.items()}
+            data = {
+                'phases': table(self.phases),
+                'file_phases': table(self.file_phases),
+                'compile_time': engine.compile_time if engine is not None else 0.0,
+                'files': [{'file': filepath, 'wall': wall, 'cpu': cpu, 'phases': laps} for filepath, wall, cpu, laps in self.files],
+                'rules': [{'src': src, 'dest': dest, 'matches': count, 'scan_time': seconds}
+                          for src, dest, count, seconds in (self.rule_records(engine) if engine is not None else [])],
+                'checks': [{'rule': engine.check_rule_text(check_id), 'findings': count}
+                           for check_id, count in enumerate(engine.check_counts)] if engine is not None else [],
+            }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+
+# 完整解析后的配置，可以整体缓存
+ResolvedConfig = namedtuple('ResolvedConfig', [
+    'folders', 'files', 'exclude_files', 'exclude_dirs', 'swaps',
+    'exclude_heading', 'exclude_pattern', 'check_rules', 'engine', 'rules_hash', 'sources'])
+
+# 配置缓存格式版本，配置解析逻辑变化时递增
+CONFIG_CACHE_VERSION = 4
+
+# 解析配置文件并整理出所有运行时需要的内容
+def resolve_config(config_file):
+    """返回ResolvedConfig，解析失败时返回None；sources为主配置和所有被包含文件的 (绝对路径, 大小, 修改时间)"""
+    sources = []
+    config = parse_config(config_file, sources)
+    if not config:
+        return None
+
+    folders = parse_config_folders(config)
+    files, exclude_files = parse_config_files(config)
+    exclude_dirs = parse_config_exclude_dirs(config)
+    swaps = parse_config_swaps(config)
+    exclude_heading = parse_config_exclude_heading(config)
+    exclude_pattern = parse_config_exclude_pattern(config)
+    check_rules = parse_config_check_rules(config)
+    fallback_encoding = parse_config_encoding(config)
+
+    # 替换规则和检查规则只编译一次，预览和实际替换共用
+    engine = SwapEngine(swaps, check_rules, fallback_encoding) if swaps else None
+    rules_hash = compute_rules_hash(swaps, exclude_heading, exclude_pattern, check_rules, fallback_encoding)
+
+    return ResolvedConfig(folders, files, exclude_files, exclude_dirs, swaps,
+                          exclude_heading, exclude_pattern, check_rules, engine, rules_hash, sources)
+
+# 计算文件内容哈希
+def file_content_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+# 加载配置，可使用缓存跳过解析
+def load_config(config_file, cache_dir=None):
+    """主配置和所有被包含文件的大小、修改时间都与缓存一致（或内容哈希一致）时，直接使用缓存的解析结果
+
+    缓存以二进制形式保存在cache_dir中，本程序自身被修改时也会失效
+    """
+    if not cache_dir:
+        return resolve_config(config_file)
+
+    abs_path = os.path.abspath(config_file)
+    path_hash = hashlib.blake2b(abs_path.encode('utf-8'), digest_size=8).hexdigest()
+    cache_path = os.path.join(cache_dir, f"config-{path_hash}.pickle")
+
+    try:
+        tool_mtime = os.stat(__file__).st_mtime_ns
+    except OSError:
+        return resolve_config(config_file)
+
+    cached = None
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') != (CONFIG_CACHE_VERSION, tool_mtime) or cached.get('path') != abs_path:
+            cached = None
+    except Exception:
+        # 缓存不存在或已损坏，重新解析
+        cached = None
+
+    def current_stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    if cached is not None:
+        # 大小和修改时间都一致时连配置文件都不需要读取
+        if all(current_stat(path) == (size, mtime) for path, size, mtime, _ in cached['sources']):
+            return cached['resolved']
+        # 只是被touch过的文件，内容哈希仍然一致
+        try:
+            if all(file_content_hash(path) == content_hash for path, _, _, content_hash in cached['sources']):
+                resolved = cached['resolved']
+                sources = [(path,) + current_stat(path) + (content_hash,) for path, _, _, content_hash in cached['sources']]
+                return save_config_cache(cache_path, tool_mtime, abs_path, resolved, sources)
+        except (OSError, TypeError):
+            pass
+
+    resolved = resolve_config(config_file)
+    # 解析出错的配置不缓存，下次仍然会输出错误信息
+    if resolved is None or not resolved.swaps:
+        return resolved
+    try:
+        sources = [(path, size, mtime, file_content_hash(path)) for path, size, mtime in resolved.sources]
+    except OSError:
+        return resolved
+    return save_config_cache(cache_path, tool_mtime, abs_path, resolved, sources)
+
+# 写入配置缓存
+def save_config_cache(cache_path, tool_mtime, abs_path, resolved, sources):
+    """sources为 (绝对路径, 大小, 修改时间, 内容哈希) 列表，返回resolved"""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump({
+                'version': (CONFIG_CACHE_VERSION, tool_mtime),
+                'path': abs_path,
+                'sources': sources,
+                'resolved': resolved,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        print(f"{YELLOW}写入配置缓存失败: {str(e)}{RESET}")
+    return resolved
+
 # 显示配置信息并根据配置模式决定是否继续执行
-def show_configuration(folders, files, exclude_files, swaps, show_cfg, exclude_heading, exclude_pattern):
+def show_configuration(folders, files, exclude_files, swaps, show_cfg, exclude_heading, exclude_pattern, exclude_dirs=None, fallback_encoding=None):
     """显示程序配置信息，并根据配置模式决定是否继续执行"""
     print(f"{CYAN}===== 幸运检查工具 ====={RESET}")
     print(f"{GREEN}搜索目录: {RESET}{', '.join(folders)}")
     print(f"{GREEN}文件匹配: {RESET}{', '.join(files)}")
     if exclude_files:
         print(f"{GREEN}排除文件: {RESET}{', '.join(exclude_files)}")
+    if exclude_dirs:
+        print(f"{GREEN}排除目录: {RESET}{', '.join(exclude_dirs)}")
     if exclude_heading:
         print(f"{GREEN}跳过包含: {RESET}{', '.join(exclude_heading)}")
     if exclude_pattern:
         print(f"{GREEN}跳过匹配: {RESET}{', '.join(exclude_pattern)}")
+    if fallback_encoding:
+        print(f"{GREEN}备用编码: {RESET}{fallback_encoding}")
     if show_cfg:
         print(f"{GREEN}替换规则: {RESET}")
         # 找出最长的src长度
@@ -836,52 +2987,175 @@ def show_configuration(folders, files, exclude_files, swaps, show_cfg, exclude_h
     print(f"{GREEN}替换规则: {RESET}{len(swaps)} 条")
     return True
 
+# 把一组文件名通配符编译为一个匹配函数
+def compile_name_matcher(patterns):
+    """返回判断文件名是否匹配任一通配符的函数；patterns为空时返回None"""
+    patterns = [pattern.strip() for pattern in patterns if pattern and pattern.strip()]
+    if not patterns:
+        return None
+
+    # fnmatch在Windows下不区分大小写，这里保持一致
+    ignore_case = os.path.normcase('A') == 'a'
+
+    # 全部是 *.ext 形式时，直接比较后缀，不需要正则
+    if all(pattern.startswith('*') and not any(c in pattern[1:] for c in '*?[') for pattern in patterns):
+        suffixes = tuple(pattern[1:].lower() if ignore_case else pattern[1:] for pattern in patterns)
+        if ignore_case:
+            return lambda name: name.lower().endswith(suffixes)
+        return lambda name: name.endswith(suffixes)
+
+    regex = re.compile('|'.join(translate(pattern) for pattern in patterns), re.IGNORECASE if ignore_case else 0)
+    return lambda name: regex.match(name) is not None
+
+# 遍历目录，返回匹配的文件路径，顺序与os.walk一致
+def walk_matching_files(folder, match_file, exclude_file=None, exclude_dir=None):
+    """用os.scandir遍历目录，排除的目录在进入之前就被剪掉"""
+    matched_files = []
+    pending = [folder]
+
+    while pending:
+        root = pending.pop()
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                # 与os.walk一样，不进入指向目录的符号链接
+                if exclude_dir is not None and exclude_dir(name):
+                    continue
+                if not entry.is_symlink():
+                    subdirs.append(os.path.join(root, name))
+            elif match_file(name) and (exclude_file is None or not exclude_file(name)):
+                matched_files.append(os.path.join(root, name))
+
+        # 倒序压栈，保证子目录按原顺序先序遍历
+        pending.extend(reversed(subdirs))
+
+    return matched_files
+
 # 收集目标文件列表
-def collect_target_files(folders, files, exclude_files):
+def collect_target_files(folders, files, exclude_files, exclude_dirs=None, show_list=True):
     """收集所有需要处理的文件列表"""
-    # 首先收集所有匹配的文件
+    # 包含、排除模式各编译一次，遍历时每个文件名只做一次匹配
+    match_file = compile_name_matcher(files)
+    exclude_file = compile_name_matcher(exclude_files)
+    exclude_dir = compile_name_matcher(exclude_dirs or [])
+
     matched_files = []
+    if match_file is not None:
+        for folder in folders:
+            matched_files.extend(walk_matching_files(folder, match_file, exclude_file, exclude_dir))
 
-    for folder in folders:
-        for root, _, filenames in os.walk(folder):
-            for filename in filenames:
-                # 检查是否匹配包含模式
-                for pattern in files:
-                    if pattern and fnmatch(filename, pattern.strip()):
-                        filepath = os.path.join(root, filename)
-                        matched_files.append(filepath)
-                        break
+    if show_list:
+        show_target_files(matched_files)
 
-    # 从匹配文件中排除不需要的文件
-    if exclude_files:
-        filtered_files = []
-        for filepath in matched_files:
-            filename = os.path.basename(filepath)
-            exclude = False
-            for pattern in exclude_files:
-                if pattern and fnmatch(filename, pattern.strip()):
-                    exclude = True
-                    break
-            if not exclude:
-                filtered_files.append(filepath)
-        matched_files = filtered_files
+    return matched_files
 
+# 打印待处理文件列表，序号即 -y N 使用的序号
+def show_target_files(target_files):
     print(f"\n{CYAN}===== 待处理文件文件列表 ====={RESET}")
-    for i, filepath in enumerate(matched_files, 1):
+    for i, filepath in enumerate(target_files, 1):
         print(f"{GREEN}[{i:3d}] {RESET}{filepath}")
     print(f"{CYAN}======================{RESET}\n")
 
-    return matched_files
+# git diff -U0 输出中的文件头和差异块头；文件名含空格时git在行尾加一个制表符
+GIT_DIFF_FILE = re.compile(r'^\+\+\+ (.*?)\t?$')
+GIT_DIFF_HUNK = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+# git路径中的C语言风格转义
+GIT_PATH_ESCAPE = re.compile(rb'\\([0-7]{3}|.)', re.S)
+GIT_PATH_ESCAPES = {b'a': b'\a', b'b': b'\b', b't': b'\t', b'n': b'\n', b'v': b'\v', b'f': b'\f', b'r': b'\r'}
+
+# 还原git加了引号的路径
+def unquote_git_path(path):
+    """含引号、反斜杠或控制字符的路径会被git加上引号并转义，其余字节（含非ASCII字符）写成三位八进制"""
+    if len(path) < 2 or not (path.startswith('"') and path.endswith('"')):
+        return path
+    def unescape(match):
+        escape = match.group(1)
+        return bytes([int(escape, 8)]) if len(escape) == 3 else GIT_PATH_ESCAPES.get(escape, escape)
+    return GIT_PATH_ESCAPE.sub(unescape, path[1:-1].encode('utf-8', 'surrogateescape')).decode('utf-8', 'surrogateescape')
+
+# 运行git命令，返回标准输出
+def run_git(*git_args):
+    """git不可用或命令失败时打印错误并返回None"""
+    try:
+        completed = subprocess.run(('git', '-c', 'core.quotepath=off') + git_args, capture_output=True)
+    except OSError as e:
+        print_error("无法运行git", None, None, str(e))
+        return None
+    if completed.returncode != 0:
+        print_error(f"git {git_args[0]} 执行失败", None, None, completed.stderr.decode('utf-8', 'replace').strip())
+        return None
+    return completed.stdout.decode('utf-8', 'surrogateescape')
+
+# 从git差异中读取改动过的行
+def read_git_changed_lines(ref='HEAD', staged=False):
+    """返回 {文件路径: 行范围列表}，行范围格式见collect_replacements；出错时返回None
+
+    staged为True时比较暂存区与ref（None表示HEAD）；否则比较工作区与ref。
+    暂存区的行号与工作区文件不一定一致，同时还有未暂存修改的文件整体检查（行范围为None）
+    """
+    toplevel = run_git('rev-parse', '--show-toplevel')
+    if toplevel is None:
+        return None
+    toplevel = toplevel.strip()
+
+    diff_args = ['diff', '-U0', '--no-color', '--no-ext-diff', '--diff-filter=d', '--src-prefix=a/', '--dst-prefix=b/']
+    if staged:
+        diff_args.append('--cached')
+    if ref:
+        diff_args.append(ref)
+    diff_output = run_git(*diff_args, '--')
+    if diff_output is None:
+        return None
+
+    changed_lines = {}
+    line_ranges = None
+    for line in diff_output.splitlines():
+        if line.startswith('+++ '):
+            # 加了引号的路径中b/前缀也在引号内，还原后再去掉
+            path = unquote_git_path(GIT_DIFF_FILE.match(line).group(1))[len('b/'):]
+            line_ranges = changed_lines.setdefault(os.path.relpath(os.path.join(toplevel, path)), [])
+        elif line.startswith('@@') and line_ranges is not None:
+            match = GIT_DIFF_HUNK.match(line)
+            if match:
+                start, count = int(match.group(1)), int(match.group(2) or 1)
+                # 只删除了行的差异块没有需要检查的内容
+                if count:
+                    line_ranges.append((start - 1, start - 1 + count))
+
+    if staged:
+        unstaged = run_git('diff', '--name-only', '-z', '--no-ext-diff', '--diff-filter=d', '--')
+        if unstaged is None:
+            return None
+        # -z时路径不加引号也不转义，以NUL分隔
+        for path in filter(None, unstaged.split('\0')):
+            path = os.path.relpath(os.path.join(toplevel, path))
+            if path in changed_lines:
+                changed_lines[path] = None
+
+    # 只删除了行的文件不需要检查
+    return {path: line_ranges for path, line_ranges in changed_lines.items() if line_ranges is None or line_ranges}
 
 # 显示处理结果
-def display_results(total, processed_files, apply_changes):
-    """显示处理结果"""
-    print(f"\n{CYAN}===== 处理结果 ====={RESET}")
-    print(f"总发现{total}处需要替换")
-    print(f"{GREEN}{processed_files} Files Processed{RESET}")
+def display_results(total, processed_files, apply_changes, file=None):
+    """显示处理结果；机器可读格式输出时写到stderr"""
+    print(f"\n{CYAN}===== 处理结果 ====={RESET}", file=file)
+    print(f"总发现{total}处需要替换", file=file)
+    print(f"{GREEN}{processed_files} Files Processed{RESET}", file=file)
 
     if not apply_changes:
-        print("\n（本次仅为预览，添加-y参数实际执行修改）")
+        print("\n（本次仅为预览，添加-y参数实际执行修改）", file=file)
 
 # 检查配置有效性
 def check_config(folders, files, swaps):
@@ -926,7 +3200,7 @@ def process_pointers_only(target_files, file_number=None):
         print(f"{YELLOW}{separator}{RESET}")
 
         # 查找并显示指针定义
-        pointer_definitions = find_pointer_definitions(filepath)
+        pointer_definitions = find_pointer_definitions(text_lines(read_source_file(filepath)[0]))
         display_pointer_definitions(filepath, pointer_definitions)
         total_pointers += len(pointer_definitions)
         processed_files += 1
@@ -941,9 +3215,475 @@ def process_pointers_only(target_files, file_number=None):
     print(f"{GREEN}{processed_files} 个文件已处理{RESET}")
     print(f"{CYAN}======================{RESET}\n")
 
+# 监视模式下判断单个路径是否属于目标文件
+class TargetFileFilter:
+    """与collect_target_files使用相同的匹配规则，用于增量维护目标文件列表"""
+
+    def __init__(self, folders, files, exclude_files, exclude_dirs=None):
+        self.folders = list(folders)
+        self.match_file = compile_name_matcher(files)
+        self.exclude_file = compile_name_matcher(exclude_files)
+        self.exclude_dir = compile_name_matcher(exclude_dirs or [])
+
+    def dir_allowed(self, name):
+        return self.exclude_dir is None or not self.exclude_dir(name)
+
+    def __call__(self, path):
+        name = os.path.basename(path)
+        if self.match_file is None or not self.match_file(name):
+            return False
+        if self.exclude_file is not None and self.exclude_file(name):
+            return False
+
+        # 相对于某个搜索目录的每一级子目录都不能被排除
+        path = os.path.normpath(path)
+        for folder in self.folders:
+            try:
+                relative = os.path.relpath(path, os.path.normpath(folder))
+            except ValueError:
+                # Windows下不在同一个盘符
+                continue
+            parts = relative.split(os.sep)
+            if parts[0] == os.pardir:
+                continue
+            if all(self.dir_allowed(part) for part in parts[:-1]):
+                return True
+        return False
+
+    def walk(self):
+        """遍历所有搜索目录，返回当前存在的目标文件"""
+        matched_files = []
+        if self.match_file is not None:
+            for folder in self.folders:
+                matched_files.extend(walk_matching_files(folder, self.match_file, self.exclude_file, self.exclude_dir))
+        return matched_files
+
+# inotify事件掩码，见 <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event 的定长部分：wd, mask, cookie, len，其后紧跟len字节的文件名
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# 收到第一个事件后再等待这么久，把编辑器保存时产生的一连串事件合并为一批
+WATCH_DEBOUNCE = 0.1
+
+# 轮询方式下两次遍历目录的间隔（秒），同时也是检查配置文件变化的间隔
+WATCH_POLL_INTERVAL = 1.0
+
+# Linux下基于inotify的目录监视
+class InotifyWatcher:
+    """通过ctypes调用libc的inotify接口，每个未被排除的目录一个watch；不可用时构造函数抛出OSError"""
+
+    def __init__(self, file_filter):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify不可用')
+        self.libc = libc
+        self.filter = file_filter
+        self.watch_dirs = {}
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1失败')
+        try:
+            for folder in file_filter.folders:
+                self.add_tree(folder, strict=True)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, root, strict=False):
+        """为root及其未被排除的子目录添加watch，返回其中已存在的目标文件
+
+        strict为True时watch数量达到上限直接抛出OSError，否则只打印警告
+        """
+        found = []
+        pending = [root]
+        while pending:
+            path = pending.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    if strict:
+                        raise OSError(err, 'inotify watch数量达到上限（fs.inotify.max_user_watches）')
+                    print(f"{YELLOW}inotify watch数量达到上限，目录 {path} 的变化将无法检测{RESET}")
+                continue
+            self.watch_dirs[wd] = path
+
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                full_path = os.path.join(path, entry.name)
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    if self.filter.dir_allowed(entry.name):
+                        pending.append(full_path)
+                elif self.filter(full_path):
+                    found.append(full_path)
+        return found
+
+    def remove_tree(self, root):
+        """移走或删除目录时，去掉其下所有watch"""
+        prefix = os.path.join(root, '')
+        for wd, path in list(self.watch_dirs.items()):
+            if path == root or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watch_dirs[wd]
+
+    def wait(self, timeout):
+        """等待文件变化，返回 (变化的目标文件集合, 删除的文件或目录集合, 是否需要全量重新扫描)"""
+        changed, deleted = set(), set()
+        rescan = False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                data = b''
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+                offset += name_length
+
+                # 事件队列溢出，已经无法知道哪些文件变化了
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watch_dirs.pop(wd, None)
+                    continue
+                root = self.watch_dirs.get(wd)
+                if root is None or not name:
+                    continue
+
+                path = os.path.join(root, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.remove_tree(path)
+                        deleted.add(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO) and self.filter.dir_allowed(name):
+                        # 新目录里可能在添加watch之前就已经有文件了
+                        changed.update(self.add_tree(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changed.discard(path)
+                    deleted.add(path)
+                elif self.filter(path):
+                    deleted.discard(path)
+                    changed.add(path)
+
+            ready, _, _ = select.select([self.fd], [], [], WATCH_DEBOUNCE)
+
+        return changed, deleted, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+# 不支持inotify时（如Windows）的轮询监视
+class PollingWatcher:
+    """每隔一段时间遍历一次目录，比较目标文件的大小和修改时间"""
+
+    def __init__(self, file_filter):
+        self.filter = file_filter
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for path in self.filter.walk():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        """接口与InotifyWatcher.wait一致"""
+        time.sleep(timeout)
+        snapshot = self.take_snapshot()
+        changed = {path for path, stamp in snapshot.items() if self.snapshot.get(path) != stamp}
+        deleted = self.snapshot.keys() - snapshot.keys()
+        self.snapshot = snapshot
+        return changed, deleted, False
+
+    def close(self):
+        pass
+
+# 创建目录监视器，优先使用inotify
+def create_file_watcher(file_filter):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(file_filter)
+        except (OSError, AttributeError) as e:
+            print(f"{YELLOW}inotify不可用（{str(e)}），改为轮询检测文件变化{RESET}")
+    return PollingWatcher(file_filter)
+
+# 配置文件（包括所有被包含的文件）当前的大小和修改时间
+def config_stamp(sources):
+    stamps = []
+    for source in sources:
+        try:
+            st = os.stat(source[0])
+            stamps.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+# 监视模式：配置和替换规则常驻内存，只重新扫描发生变化的文件
+def watch_target_files(args, resolved, target_files, reporter):
+    """配置文件或其包含的文件变化时自动重新加载配置并全量扫描一次；按Ctrl+C退出"""
+    def make_filter(resolved):
+        return TargetFileFilter(resolved.folders, resolved.files, resolved.exclude_files, resolved.exclude_dirs)
+
+    def scan_changed(paths):
+        """扫描一批文件，单个批次出错不影响继续监视"""
+        paths = sorted(path for path in paths if os.path.isfile(path))
+        if not paths:
+            return
+        try:
+            total, _ = process_matching_files(paths, resolved.engine, False, None, resolved.exclude_heading,
+                                              resolved.exclude_pattern, args.check_pointer, 1, None, reporter)
+        except (OSError, UnicodeDecodeError) as e:
+            print_error("处理文件失败", None, None, str(e))
+            return
+        # 与display_results一样，安静模式下也输出统计
+        print(f"{CYAN}[{datetime.now().strftime('%H:%M:%S')}] 重新检查 {len(paths)} 个文件，发现{total}处需要替换{RESET}",
+              file=None if args.output_format == 'text' else sys.stderr)
+
+    # 以规范化路径为键，值为显示用的路径
+    targets = {os.path.normpath(path): path for path in target_files}
+    file_filter = make_filter(resolved)
+    watcher = create_file_watcher(file_filter)
+    stamp = config_stamp(resolved.sources)
+    mode = 'inotify' if isinstance(watcher, InotifyWatcher) else '轮询'
+    reporter.note(f"\n{CYAN}===== 监视模式（{mode}），按Ctrl+C退出 ====={RESET}")
+
+    try:
+        while True:
+            changed, deleted, rescan = watcher.wait(WATCH_POLL_INTERVAL)
+
+            # 配置变化：重新解析，规则有误时保留旧配置继续监视
+            current_stamp = config_stamp(resolved.sources)
+            if current_stamp != stamp:
+                stamp = current_stamp
+                reloaded = load_config(args.config, args.cache_dir)
+                if reloaded and check_config(reloaded.folders, reloaded.files, reloaded.swaps):
+                    resolved = reloaded
+                    stamp = config_stamp(resolved.sources)
+                    watcher.close()
+                    file_filter = make_filter(resolved)
+                    watcher = create_file_watcher(file_filter)
+                    reporter.note(f"\n{CYAN}配置已重新加载，替换规则 {len(resolved.swaps)} 条{RESET}")
+                    rescan = True
+                else:
+                    reporter.note(f"{YELLOW}新配置无效，继续使用原有配置{RESET}")
+
+            if rescan:
+                targets = {os.path.normpath(path): path for path in file_filter.walk()}
+                scan_changed(targets.values())
+                continue
+
+            # 删除的可能是文件，也可能是整个目录
+            for path in deleted:
+                key = os.path.normpath(path)
+                prefix = os.path.join(key, '')
+                for target in [t for t in targets if t == key or t.startswith(prefix)]:
+                    reporter.note(f"{GRAY}文件已移除: {targets.pop(target)}{RESET}")
+
+            for path in changed:
+                targets.setdefault(os.path.normpath(path), path)
+            scan_changed(targets[os.path.normpath(path)] for path in changed)
+    except KeyboardInterrupt:
+        reporter.note(f"\n{CYAN}监视已停止{RESET}")
+    finally:
+        watcher.close()
+
+# 收集命中记录的报告器，检查服务用它把结果返回给客户端
+class RecordCollector:
+    """记录格式与JsonlReporter输出的一致"""
+
+    def __init__(self, engine, max_hits=None):
+        self.engine = engine
+        self.max_hits = max_hits
+        self.records = []
+        # {'file': 文件路径, 'error': 原因}
+        self.errors = []
+
+    def note(self, message):
+        pass
+
+    def report_file(self, file_index, filepath, result, check_pointer):
+        self.records.extend(iter_hit_records(filepath, self.engine, result.replacements, result.pointers, self.max_hits, result.findings, result.lines))
+
+    def report_error(self, file_index, filepath, message):
+        self.errors.append({'file': filepath, 'error': message})
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# 常驻的检查服务：配置和替换规则只加载一次，配置文件变化时自动重新加载
+class CheckService:
+    """处理客户端的JSON请求，--serve模式和客户端回退到进程内检查时共用
+
+    请求格式：
+        {"op": "check", "paths": [...], "pointers": false, "max_hits": null}
+        {"op": "check_text", "text": "...", "path": "显示用的文件名", "pointers": false}
+        {"op": "apply", "paths": [...]}
+        {"op": "ping"}
+    返回 {"ok": true, ...} 或 {"ok": false, "error": "..."}；check和apply中单个文件无法读取或解码时不影响其余文件，
+    原因逐个放在 "errors": [{"file": ..., "error": ...}] 中
+    """
+
+    def __init__(self, config_file, cache_dir=None):
+        self.config_file = config_file
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        # 同一时间只允许一个请求改写文件
+        self.apply_lock = threading.Lock()
+        self.resolved = None
+        self.stamp = None
+        self.reload()
+
+    def reload(self):
+        resolved = load_config(self.config_file, self.cache_dir)
+        if not resolved or not resolved.swaps:
+            raise ValueError(f"配置文件 {self.config_file} 无效")
+        self.resolved = resolved
+        self.stamp = config_stamp(resolved.sources)
+
+    def current(self):
+        """返回当前配置，配置文件或其包含的文件变化时先重新加载"""
+        with self.lock:
+            if config_stamp(self.resolved.sources) != self.stamp:
+                try:
+                    self.reload()
+                except ValueError:
+                    # 新配置无效时继续使用原有配置，下次请求不再重复解析
+                    self.stamp = config_stamp(self.resolved.sources)
+            return self.resolved
+
+    def handle(self, request):
+        op = request.get('op')
+        try:
+            if op == 'ping':
+                return {'ok': True, 'pid': os.getpid(), 'rules': len(self.current().swaps)}
+            if op == 'check':
+                return self.check_files(request.get('paths') or [], False, request.get('pointers', False), request.get('max_hits'))
+            if op == 'apply':
+                with self.apply_lock:
+                    return self.check_files(request.get('paths') or [], True, False, None)
+            if op == 'check_text':
+                return self.check_text(request.get('text', ''), request.get('path') or '<buffer>', request.get('pointers', False), request.get('max_hits'))
+            return {'ok': False, 'error': f"未知的请求类型: {op}"}
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            return {'ok': False, 'error': str(e)}
+
+    def check_files(self, paths, apply_changes, check_pointer, max_hits):
+        resolved = self.current()
+        collector = RecordCollector(resolved.engine, max_hits)
+        total, processed_files = process_matching_files(paths, resolved.engine, apply_changes, None, resolved.exclude_heading,
+                                                        resolved.exclude_pattern, check_pointer, 1, None, collector)
+        return {'ok': True, 'total': total, 'files': processed_files, 'hits': collector.records, 'errors': collector.errors}
+
+    def check_text(self, text, display_path, check_pointer, max_hits):
+        resolved = self.current()
+        lines = io.StringIO(text, newline=None).readlines()
+        spans, count, findings = collect_replacements(lines, resolved.engine, resolved.exclude_heading, resolved.exclude_pattern)
+        pointer_definitions = find_pointer_definitions(lines) if check_pointer else None
+        hits = list(iter_hit_records(display_path, resolved.engine, spans, pointer_definitions, max_hits, findings))
+        return {'ok': True, 'total': count, 'files': 1, 'hits': hits}
+
+# 每个连接一个线程，连接上可以连续发送多个请求，每行一个JSON
+class CheckRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("请求必须是JSON对象")
+                response = self.server.service.handle(request)
+            except ValueError as e:
+                response = {'ok': False, 'error': f"无效的请求: {str(e)}"}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class CheckServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+# 在Unix域套接字上提供检查服务
+def serve_checks(config_file, socket_path, cache_dir=None):
+    """按Ctrl+C退出，退出时删除套接字文件"""
+    if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        print_error("当前系统不支持Unix域套接字，无法启动检查服务")
+        return
+
+    # 套接字文件已存在时，先确认是否还有服务在运行
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print_error("检查服务已经在运行", None, None, socket_path)
+            return
+        except OSError:
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    try:
+        service = CheckService(config_file, cache_dir)
+    except ValueError as e:
+        print_error(str(e))
+        return
+
+    # 服务可以改写文件，套接字只允许当前用户访问
+    old_umask = os.umask(0o177)
+    try:
+        server = CheckServer(socket_path, CheckRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.service = service
+
+    print(f"{CYAN}===== 检查服务已启动，按Ctrl+C退出 ====={RESET}")
+    print(f"{GREEN}套接字: {RESET}{socket_path}")
+    print(f"{GREEN}替换规则: {RESET}{len(service.resolved.swaps)} 条")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{CYAN}检查服务已停止{RESET}")
+    finally:
+        server.server_close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
 # 主函数
 def main():
-    parser = argparse.ArgumentParser(description='幸运检查工具', prefix_chars='-/')
+    # Windows下保留 / 作为选项前缀；其他平台的绝对路径以 / 开头，--socket、-o 等选项的参数会被当作选项
+    parser = argparse.ArgumentParser(description='幸运检查工具', prefix_chars='-/' if os.name == 'nt' else '-')
     parser.add_argument('-y', '--yes', nargs='?', const=0, type=int, dest='file_number',
                       help='实际执行文件修改。如果指定数字，则只处理该序号的文件（从1开始）')
     parser.add_argument('-s', '--show', dest='show_cfg', action='store_true',
@@ -952,49 +3692,155 @@ def main():
                       help='检查指针定义')
     parser.add_argument('-c', '--config', default='config.ini',
                       help='指定配置文件路径，默认为config.ini')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='并行处理的进程数，默认为1（不并行）')
+    parser.add_argument('--cache', nargs='?', const='.luckcache', default=None, dest='cache_dir',
+                      help='启用配置和增量结果缓存，可指定缓存目录，默认为.luckcache')
+    parser.add_argument('--cache-size', type=int, default=64,
+                      help='缓存大小上限（MB），默认为64')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'sarif'], default='text', dest='output_format',
+                      help='输出格式：text（彩色文本，默认）、jsonl（每条命中一行JSON）、sarif')
+    parser.add_argument('-o', '--output', default=None,
+                      help='jsonl/sarif 格式的输出文件，默认输出到标准输出')
+    parser.add_argument('--max-hits-per-file', type=int, default=None, dest='max_hits',
+                      help='每个文件最多输出的替换数量，超出部分只统计不显示（修改日志不受影响）')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                      help='不输出配置、文件列表和每个文件的详细内容，只输出统计结果')
+    parser.add_argument('-w', '--watch', action='store_true',
+                      help='处理完成后继续监视目录，文件或配置变化时自动重新检查（不能与-y同时使用）')
+    parser.add_argument('--changed', nargs='?', const='HEAD', default=None, metavar='REF',
+                      help='只检查与REF（默认为HEAD）相比改动过的行，用于提交前检查；修改时也只改这些行')
+    parser.add_argument('--staged', action='store_true',
+                      help='只检查暂存区中改动过的行（git diff --cached），可与--changed REF同时使用')
+    parser.add_argument('--serve', action='store_true',
+                      help='作为检查服务常驻运行，通过Unix域套接字接收LuckClient.py的请求')
+    parser.add_argument('--socket', default=None, dest='socket_path',
+                      help='检查服务的套接字路径，默认根据配置文件路径生成')
+    parser.add_argument('--stream-size', type=int, default=STREAM_FILE_SIZE // (1024 * 1024), metavar='MB',
+                      help=f"不小于该大小（MB）的文件逐块流式处理，内存占用与文件大小无关，默认为{STREAM_FILE_SIZE // (1024 * 1024)}")
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                      help='用N个线程预读后面的文件，修改时在后台写回，用于网络文件系统；只在不使用-j时生效')
+    parser.add_argument('--query', default=None, metavar='TOKEN',
+                      help='从标识符索引中查询TOKEN出现的文件和行，多个标识符时只列出同时出现的行')
+    parser.add_argument('--profile', action='store_true',
+                      help='记录各阶段和每个文件的耗时、每条规则的命中次数和单独扫描时间，结束时输出汇总')
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+                      help='性能分析汇总中列出的文件和规则数量，默认为10')
+    parser.add_argument('--profile-output', default=None, metavar='FILE',
+                      help='把性能分析结果导出到文件（隐含--profile）')
+    parser.add_argument('--profile-format', choices=['json', 'chrome'], default='json',
+                      help='导出格式：json（汇总数据，默认）、chrome（Chrome trace，可用chrome://tracing或Perfetto打开）')
     args = parser.parse_args()
 
-    # 解析配置文件
-    config = parse_config(args.config)
-    if not config:
+    # 检查服务模式：配置和规则常驻内存，文件由客户端指定
+    if args.serve:
+        from LuckClient import default_socket_path
+        serve_checks(args.config, args.socket_path or default_socket_path(args.config), args.cache_dir)
         return
 
-    # 缓存配置解析结果
-    folders = parse_config_folders(config)
-    files, exclude_files = parse_config_files(config)
-    swaps = parse_config_swaps(config)
-    exclude_heading = parse_config_exclude_heading(config)
-    exclude_pattern = parse_config_exclude_pattern(config)
+    # 监视模式只做预览，保存文件时自动改写会与编辑器冲突
+    if args.watch and args.file_number is not None:
+        print_error("监视模式不能与-y同时使用")
+        return
+    if args.watch and args.output_format == 'sarif':
+        print_error("监视模式不支持sarif格式，请使用text或jsonl")
+        return
+
+    # 性能分析：未开启时各阶段不做计时
+    profiler = Profiler() if args.profile or args.profile_output else None
+    phase = profiler.phase if profiler is not None else lambda name: contextlib.nullcontext()
+
+    # 解析配置文件（启用缓存时优先使用缓存的解析结果）
+    with phase('config'):
+        resolved = load_config(args.config, args.cache_dir)
+    if not resolved:
+        return
+
+    folders, files, exclude_files, exclude_dirs = resolved.folders, resolved.files, resolved.exclude_files, resolved.exclude_dirs
+    swaps, exclude_heading, exclude_pattern = resolved.swaps, resolved.exclude_heading, resolved.exclude_pattern
+    engine = resolved.engine
 
     # 检查配置有效性
     if not check_config(folders, files, swaps):
         return
 
-    # 显示配置信息并决定是否继续执行
-    if not show_configuration(folders, files, exclude_files, swaps, args.show_cfg, exclude_heading, exclude_pattern):
+    # 只有彩色文本且非安静模式才输出配置和文件列表
+    verbose = args.output_format == 'text' and not args.quiet
+
+    # 查询标识符：只更新索引，不做替换检查
+    if args.query is not None:
+        query_identifiers(args.query, args.cache_dir or '.luckcache',
+                          collect_target_files(folders, files, exclude_files, exclude_dirs, False), engine.fallback_encoding)
         return
 
+    # 显示配置信息并决定是否继续执行
+    if verbose or args.show_cfg:
+        if not show_configuration(folders, files, exclude_files, swaps, args.show_cfg, exclude_heading, exclude_pattern, exclude_dirs,
+                                  engine.fallback_encoding):
+            return
+
     # 如果只是显示配置，到这里就结束
     if args.show_cfg:
         return
 
-    # 获取所有匹配的文件
-    target_files = collect_target_files(folders, files, exclude_files)
+    # 获取所有匹配的文件；只检查改动时直接从git差异中筛选，不需要遍历目录
+    changed_lines = None
+    if args.changed is not None or args.staged:
+        changed_lines = read_git_changed_lines(args.changed, args.staged)
+        if changed_lines is None:
+            return
+        file_filter = TargetFileFilter(folders, files, exclude_files, exclude_dirs)
+        target_files = [path for path in changed_lines if file_filter(path) and os.path.isfile(path)]
+        if verbose:
+            show_target_files(target_files)
+    else:
+        with phase('collect_files'):
+            target_files = collect_target_files(folders, files, exclude_files, exclude_dirs, verbose)
     if not target_files:
         print_error("未找到需要处理的文件")
         return
 
     # 是否实际执行修改
     apply_changes = args.file_number is not None
-    if not apply_changes:
+    if not apply_changes and verbose:
         print("\n（本次仅为预览，添加-y参数实际执行修改）")
 
     # 处理目标文件
     target_file_number = args.file_number if args.file_number and args.file_number > 0 else None
-    total, processed_files = process_matching_files(target_files, swaps, apply_changes, target_file_number, exclude_heading, exclude_pattern, args.check_pointer)
 
-    # 显示处理结果
-    display_results(total, processed_files, apply_changes)
+    # 增量结果缓存，规则集变化时自动作废；只新增替换规则时借助标识符索引保留不受影响的文件
+    cache = None
+    if args.cache_dir and changed_lines is None:
+        with phase('cache_load'):
+            index = IdentifierIndex(args.cache_dir, engine.fallback_encoding)
+            index.update(target_files)
+            index.save()
+            rules = (list(engine.swaps), resolved.exclude_heading, resolved.exclude_pattern, resolved.check_rules, engine.fallback_encoding)
+            cache = ResultCache(args.cache_dir, resolved.rules_hash, args.cache_size * 1024 * 1024, rules, index)
+        if cache.kept_after_rule_change is not None and verbose:
+            print(f"\n{GRAY}替换规则有新增，{cache.kept_after_rule_change} 个文件不含新规则的源文本，沿用缓存结果{RESET}")
+
+    reporter = create_reporter(args.output_format, engine, args.quiet, args.output, args.max_hits)
+    try:
+        with phase('process'):
+            total, processed_files = process_matching_files(target_files, engine, apply_changes, target_file_number, exclude_heading, exclude_pattern, args.check_pointer, args.jobs, cache, reporter, changed_lines, profiler, args.stream_size * 1024 * 1024, args.prefetch)
+
+        # 显示处理结果
+        display_results(total, processed_files, apply_changes, None if args.output_format == 'text' else sys.stderr)
+        display_check_results(engine, None if args.output_format == 'text' else sys.stderr)
+
+        # 性能分析汇总，监视模式下只统计第一次检查
+        if profiler is not None:
+            profiler.report(engine, args.profile_top, None if args.output_format == 'text' else sys.stderr)
+            if args.profile_output:
+                profiler.export(args.profile_output, engine, args.profile_format)
+                print(f"{GREEN}性能分析结果已保存到: {args.profile_output}{RESET}", file=None if args.output_format == 'text' else sys.stderr)
+
+        # 监视模式：继续监视目录和配置文件的变化
+        if args.watch:
+            watch_target_files(args, resolved, target_files, reporter)
+    finally:
+        reporter.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
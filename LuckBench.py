@@ -0,0 +1,412 @@
+# 功能解释
+# LuckChecker的性能基准测试
+# 1. 按固定的随机种子生成C/C++合成代码库，文件数、行长、替换源密度、字符串和注释密度都可调，并包含压缩后的超长行
+# 2. 使用真实的config.ini规则集，分别计时解析配置、编译规则、收集文件、读取、预筛选、收集替换位置、指针分析、应用替换各阶段
+# 3. 结果可保存为基准，之后的运行与基准逐项比较，变慢超过阈值时标红并以退出码1结束
+# 4. --check-cache 检查新增替换规则后沿用的结果缓存，修改结果应与不用缓存时完全相同
+# 5. --check-cases 在固定的小样例上检查替换、命名检查和指针分析的结果
+
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Luck
+from Luck import GRAY, RED, GREEN, CYAN, YELLOW, RESET
+
+# 基准数据格式版本，阶段划分或语料生成方式变化时递增
+BENCH_VERSION = 3
+
+# 测试场景：files 文件数，lines 每个文件的行数，width 平均行宽，swap_density 替换源占标识符的比例，
+# literal_density 带字符串或注释的行所占比例，minified 每个文件中压缩后的超长行数
+SCENARIOS = {
+    'many-small':  dict(files=400, lines=60,   width=40,  swap_density=0.05, literal_density=0.2, minified=0),
+    'large-files': dict(files=8,   lines=8000, width=60,  swap_density=0.05, literal_density=0.2, minified=0),
+    'swap-dense':  dict(files=20,  lines=2000, width=60,  swap_density=0.4,  literal_density=0.1, minified=0),
+    'literal-heavy': dict(files=20, lines=2000, width=80, swap_density=0.05, literal_density=0.8, minified=0),
+    'no-hits':     dict(files=40,  lines=2000, width=60,  swap_density=0.0,  literal_density=0.2, minified=0),
+    'minified':    dict(files=4,   lines=200,  width=60,  swap_density=0.05, literal_density=0.2, minified=3),
+}
+
+# 计时的阶段，按流水线顺序排列
+STAGES = ['parse_config', 'compile', 'collect_files', 'read', 'prefilter',
+          'collect_replacements', 'pointers', 'apply']
+
+# 合成代码使用的普通标识符和类型，类型中与替换源相同的由plain_types去掉
+PLAIN_WORDS = ['count', 'index', 'buffer', 'length', 'result', 'handle', 'value', 'offset',
+               'state', 'flags', 'node', 'next', 'data', 'size', 'item', 'total']
+PLAIN_TYPES = ['int', 'char', 'float', 'double', 'size_t', 'Node', 'Context']
+OPERATORS = [' = ', ' + ', ' - ', ' * ', ' == ', ' != ', ' < ', ', ']
+FILE_SUFFIXES = ['.c', '.cpp', '.h', '.hpp']
+
+# 不是替换源的普通类型，swap_density为0时合成代码中不应有任何替换
+def plain_types(sources):
+    source_set = set(sources)
+    return [type_name for type_name in PLAIN_TYPES if type_name not in source_set]
+
+# 生成一个标识符，按密度选用替换源
+def random_word(rng, sources, swap_density):
+    if sources and rng.random() < swap_density:
+        return rng.choice(sources)
+    return rng.choice(PLAIN_WORDS) + str(rng.randrange(100))
+
+# 生成一行语句，宽度约为width
+def random_statement(rng, sources, swap_density, width):
+    parts = []
+    length = 0
+    while length < width:
+        part = random_word(rng, sources, swap_density)
+        parts.append(part)
+        length += len(part) + 3
+        parts.append(rng.choice(OPERATORS))
+    parts.pop()
+    return ''.join(parts) + ';'
+
+# 生成一行代码，可能带字符串、字符、注释或指针定义；types为可用的普通类型，line_comment为False时不生成 // 注释
+def random_line(rng, sources, types, params, line_comment=True):
+    swap_density, width = params['swap_density'], params['width']
+    kind = rng.random()
+    if kind < 0.05:
+        return f"{rng.choice(types)} *{random_word(rng, sources, swap_density)} = {random_word(rng, sources, swap_density)};"
+    statement = random_statement(rng, sources, swap_density, width)
+    if rng.random() >= params['literal_density']:
+        return statement
+    # 字符串和注释中的替换源不应被替换，这里故意混入
+    literal = random_statement(rng, sources, swap_density, width // 2)
+    choice = rng.randrange(4) if line_comment else rng.choice((0, 2, 3))
+    if choice == 0:
+        return f'{statement} printf("{literal}\\n");'
+    if choice == 1:
+        return f"{statement} // {literal}"
+    if choice == 2:
+        return f"{statement} {types[0]} c = '\\''; /* {literal} */"
+    return f"/* {literal}\n   {literal} */ {statement}"
+
+# 生成一个文件的内容
+def generate_file(rng, sources, types, params):
+    lines = [f"#include \"{rng.choice(PLAIN_WORDS)}.h\"", f"{types[0]} func() {{"]
+    for _ in range(params['lines']):
+        lines.append('    ' + random_line(rng, sources, types, params))
+    for _ in range(params['minified']):
+        # 压缩后的代码：一行中有几千条语句，没有换行；// 会注释掉行内其余的代码，这里只用块注释
+        lines.append(' '.join(random_line(rng, sources, types, params, line_comment=False).replace('\n', ' ') for _ in range(5000)))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+# 生成一个场景的合成代码库
+def generate_corpus(root, name, params, sources, seed):
+    """同样的种子、参数和规则集总是生成完全相同的文件，返回内容的哈希用于确认基准可比"""
+    corpus_hash = hashlib.blake2b(digest_size=16)
+    types = plain_types(sources)
+    for file_index in range(params['files']):
+        rng = random.Random(f"{seed}/{name}/{file_index}")
+        folder = os.path.join(root, f"dir{file_index % 10}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"file{file_index}{FILE_SUFFIXES[file_index % len(FILE_SUFFIXES)]}")
+        content = generate_file(rng, sources, types, params).encode('utf-8')
+        corpus_hash.update(content)
+        with open(path, 'wb') as f:
+            f.write(content)
+    return corpus_hash.hexdigest()
+
+# 多次执行取最短时间，减少其他进程的干扰
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+# 对一个场景逐阶段计时
+def run_scenario(config_file, root, repeat):
+    """返回 ({阶段: 秒}, 统计信息)"""
+    timings = {}
+
+    # 解析配置不会输出，除非配置有误；每次先清空已读取的配置行，否则之后各次只计到缓存查找
+    def parse_config():
+        Luck._config_lines_cache.clear()
+        return Luck.resolve_config(config_file)
+    timings['parse_config'], resolved = best_time(parse_config, repeat)
+    if not resolved:
+        raise ValueError(f"配置文件解析失败: {config_file}")
+
+    def compile_rules():
+        engine = Luck.SwapEngine(resolved.swaps, resolved.check_rules, resolved.engine.fallback_encoding)
+        # 正则按需编译，这里全部访问一次
+        engine.pattern
+        engine.byte_pattern
+        engine.check_pattern
+        engine.check_byte_pattern
+        return engine
+    timings['compile'], engine = best_time(compile_rules, repeat)
+
+    timings['collect_files'], target_files = best_time(
+        lambda: Luck.collect_target_files([root], resolved.files, resolved.exclude_files, resolved.exclude_dirs, False), repeat)
+
+    def read_all():
+        contents = []
+        for path in target_files:
+            with open(path, 'rb') as f:
+                data = f.read()
+            contents.append((data, Luck.decode_source(data, engine.fallback_encoding)[0]))
+        return contents
+    timings['read'], contents = best_time(read_all, repeat)
+
+    timings['prefilter'], matched = best_time(lambda: [engine.may_match(data) for data, _ in contents], repeat)
+
+    def collect_all():
+        return [Luck.collect_replacements(lines, engine, resolved.exclude_heading, resolved.exclude_pattern)
+                for _, lines in contents]
+    timings['collect_replacements'], collected = best_time(collect_all, repeat)
+
+    timings['pointers'], definitions = best_time(
+        lambda: [Luck.find_pointer_definitions(Luck.text_lines(lines)) for _, lines in contents], repeat)
+
+    timings['apply'], _ = best_time(
+        lambda: [Luck.apply_replacements(lines, result[0], engine) for (_, lines), result in zip(contents, collected)], repeat)
+
+    stats = {
+        'files': len(target_files),
+        'bytes': sum(len(data) for data, _ in contents),
+        'matched_files': sum(matched),
+        'hits': sum(result[1] for result in collected),
+        'findings': sum(len(result[2]) for result in collected),
+        'pointers': sum(len(found) for found in definitions),
+    }
+    return timings, stats
+
+# 固定样例：(说明, 配置中的规则, 源代码, 记录类别, 比较的字段, 期望结果)
+# 记录类别为swap、check或pointer，结果为按位置排列的命中记录中这些字段组成的元组
+CHECK_CASES = [
+    ('指针类型保留*之后的const', 'Swap = zzz / yyy', 'bool * const x;\nchar *const *p;\n',
+     'pointer', ('src',), [('bool * const x',), ('char *const *p',)]),
+    ('起点不同的重叠多词规则按长度优先', 'Swap = "a bb" / "Y" , "bb cc" / "X"', 'a bb cc;\na bb; bb cc;\n',
+     'swap', ('line', 'col', 'src', 'dest'), [(1, 3, 'bb cc', 'X'), (2, 1, 'a bb', 'Y'), (2, 7, 'bb cc', 'X')]),
+    ('第一行的列号从BOM之后算起', 'Swap = zzz / yyy', '\ufeffzzz x; zzz y;\nzzz z;\n',
+     'swap', ('line', 'col'), [(1, 1), (1, 8), (2, 1)]),
+    ('类型为*的规则命中时没有声明类型', 'Swap = zzz / yyy\nCheck = bool * m_b\nCheck = * m_* m_[bA-Z]', 'bool *m_x, m_y;\nint m_z;\n',
+     'check', ('line', 'src', 'rule', 'type'), [(1, 'm_x', 'check0', 'bool *'), (1, 'm_x', 'check1', None),
+                                               (1, 'm_y', 'check0', 'bool'), (1, 'm_y', 'check1', None), (2, 'm_z', 'check1', None)]),
+]
+
+# 检查固定样例的扫描结果
+def check_cases():
+    """返回是否全部符合期望"""
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix='luckbench-') as temp_dir:
+        config_file = os.path.join(temp_dir, 'case.ini')
+        for description, rules, source, kind, fields, expected in CHECK_CASES:
+            with open(config_file, 'w', encoding='utf-8') as f:
+                f.write(rules + '\n')
+            Luck._config_lines_cache.clear()
+            resolved = Luck.resolve_config(config_file)
+            lines = source.splitlines(keepends=True)
+            spans, _, findings = Luck.collect_replacements(lines, resolved.engine, resolved.exclude_heading, resolved.exclude_pattern)
+            records = Luck.iter_hit_records('case', resolved.engine, spans, Luck.find_pointer_definitions(lines), findings=findings, lines=lines)
+            actual = [tuple(record.get(field) for field in fields) for record in records
+                      if (record['rule'] if record['rule'] == 'pointer' else record['category']) == kind]
+            if actual != expected:
+                failed += 1
+                print(f"{RED}不符合期望: {description}{RESET}\n  期望 {expected}\n  实际 {actual}")
+    if failed:
+        return False
+    print(f"{GREEN}{len(CHECK_CASES)} 个固定样例全部符合期望{RESET}")
+    return True
+
+# 写出只含替换规则的配置文件，搜索当前目录
+def write_swap_config(path, swaps):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('Folder = "."\nFiles = *.c , *.h , *.cpp , *.hpp\n')
+        f.write('Swap = ' + ' , '.join(f'"{src}" / "{dest}"' for src, dest in swaps) + '\n')
+
+# 读取目录下所有文件的内容
+def read_tree(root):
+    contents = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as f:
+                contents[os.path.relpath(path, root)] = f.read()
+    return contents
+
+# 检查新增替换规则后沿用的结果缓存
+def check_cache_rule_addition(swaps, seed):
+    """先用少了排序最靠前那条规则的配置建立缓存，再用完整规则加 -y --cache 修改，结果应与不用缓存直接 -y 相同；
+    去掉的规则排在最前，其余规则的编号在两次运行之间都会变化。返回是否一致
+    """
+    params = dict(SCENARIOS['many-small'], files=100)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Luck.py')
+    with tempfile.TemporaryDirectory(prefix='luckbench-') as temp_dir:
+        cached_root = os.path.join(temp_dir, 'cached')
+        fresh_root = os.path.join(temp_dir, 'fresh')
+        generate_corpus(cached_root, 'many-small', params, [src for src, _ in swaps], seed)
+        shutil.copytree(cached_root, fresh_root)
+        write_swap_config(os.path.join(temp_dir, 'old.ini'), swaps[1:])
+        write_swap_config(os.path.join(temp_dir, 'new.ini'), swaps)
+
+        def run(root, *args):
+            subprocess.run([sys.executable, script, '-q', *args], cwd=root, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run(cached_root, '-c', '../old.ini', '--cache')
+        run(cached_root, '-c', '../new.ini', '-y', '--cache')
+        run(fresh_root, '-c', '../new.ini', '-y')
+
+        ignore = lambda path: path.startswith('.luckcache') or path.startswith('SwapLog')
+        cached = {path: data for path, data in read_tree(cached_root).items() if not ignore(path)}
+        fresh = {path: data for path, data in read_tree(fresh_root).items() if not ignore(path)}
+        different = sorted(path for path in fresh if cached.get(path) != fresh[path])
+    if different:
+        print(f"{RED}沿用缓存的修改结果与不用缓存时不同: {', '.join(different[:5])}{RESET}")
+        return False
+    print(f"{GREEN}新增替换规则后沿用缓存的修改结果正确（{len(fresh)} 个文件）{RESET}")
+    return True
+
+# 读取基准数据
+def load_baseline(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"{YELLOW}基准文件无法读取，已忽略: {str(e)}{RESET}")
+        return None
+    if baseline.get('version') != BENCH_VERSION:
+        print(f"{YELLOW}基准文件版本不同，已忽略: {path}{RESET}")
+        return None
+    return baseline
+
+# 显示一个场景的结果，与基准比较
+def report_scenario(name, result, baseline_result, threshold, min_time):
+    """返回变慢超过阈值的阶段列表"""
+    stats = result['stats']
+    print(f"\n{CYAN}===== {name} ====={RESET} {GRAY}{stats['files']} 个文件，{stats['bytes'] / 1024 / 1024:.1f} MB，"
+          f"{stats['hits']} 处替换，{stats['findings']} 处命名问题，{stats['pointers']} 个指针{RESET}")
+
+    if baseline_result is not None and baseline_result['corpus_hash'] != result['corpus_hash']:
+        print(f"{YELLOW}合成代码与基准不同（规则集或生成参数有变化），不做比较{RESET}")
+        baseline_result = None
+    if baseline_result is not None and baseline_result['stats'] != stats:
+        # 同样的输入得到不同的结果，说明扫描逻辑有变化，时间仍然照常比较
+        print(f"{YELLOW}统计结果与基准不同: {baseline_result['stats']}{RESET}")
+
+    regressions = []
+    for stage in STAGES:
+        seconds = result['timings'][stage]
+        line = f"  {stage:<22}{seconds * 1000:>10.2f} ms"
+        base = baseline_result['timings'].get(stage) if baseline_result else None
+        if base:
+            ratio = seconds / base
+            change = f"{(ratio - 1) * 100:+7.1f}%  (基准 {base * 1000:.2f} ms)"
+            # 太短的阶段受计时误差影响大，不判定为变慢
+            if ratio > 1 + threshold and seconds - base > min_time:
+                regressions.append(stage)
+                line += f"  {RED}{change} 变慢{RESET}"
+            elif ratio < 1 - threshold:
+                line += f"  {GREEN}{change}{RESET}"
+            else:
+                line += f"  {GRAY}{change}{RESET}"
+        print(line)
+    return regressions
+
+# 主函数
+def main():
+    parser = argparse.ArgumentParser(description='幸运检查工具性能基准测试')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                      help=f"要运行的场景，默认全部：{', '.join(SCENARIOS)}")
+    parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'),
+                      help='规则集所在的配置文件，默认为本目录下的config.ini')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                      help='每个阶段的重复次数，取最短时间，默认为3')
+    parser.add_argument('--seed', default='luck',
+                      help='生成合成代码的随机种子，默认为luck')
+    parser.add_argument('--scale', type=float, default=1.0,
+                      help='按比例增减每个场景的文件数，默认为1.0')
+    parser.add_argument('--corpus', default=None,
+                      help='把合成代码保存到该目录，默认使用临时目录并在结束后删除')
+    parser.add_argument('--baseline', default='LuckBench.json',
+                      help='基准数据文件，默认为LuckBench.json')
+    parser.add_argument('--save', action='store_true',
+                      help='把本次结果保存为新的基准')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                      help='比基准慢多少（比例）算作变慢，默认为0.2')
+    parser.add_argument('--min-time', type=float, default=0.005,
+                      help='比基准多用的时间少于该秒数时不算变慢，默认为0.005')
+    parser.add_argument('--check-cache', action='store_true',
+                      help='不计时，只检查新增替换规则后沿用的结果缓存是否正确')
+    parser.add_argument('--check-cases', action='store_true',
+                      help='不计时，只检查固定样例的替换、命名检查和指针分析结果')
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+
+    resolved = Luck.resolve_config(args.config)
+    if not resolved:
+        return 2
+    if args.check_cache:
+        return 0 if check_cache_rule_addition(resolved.swaps, args.seed) else 1
+    if args.check_cases:
+        return 0 if check_cases() else 1
+    sources = [src for src, _ in resolved.swaps]
+    baseline = None if args.save else load_baseline(args.baseline)
+    names = args.scenarios or list(SCENARIOS)
+
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory(prefix='luckbench-') as temp_dir:
+        for name in names:
+            params = dict(SCENARIOS[name])
+            params['files'] = max(1, round(params['files'] * args.scale))
+            root = os.path.join(args.corpus or temp_dir, name)
+            corpus_hash = generate_corpus(root, name, params, sources, args.seed)
+            try:
+                timings, stats = run_scenario(args.config, root, args.repeat)
+            except ValueError as e:
+                print(f"{RED}错误: {RESET}{str(e)}")
+                return 2
+            if params['swap_density'] == 0 and stats['hits']:
+                # 合成代码混入了替换源，这个场景测的就不是没有命中的情况
+                print(f"{RED}错误: {RESET}场景 {name} 不应有替换，实际有 {stats['hits']} 处")
+                return 2
+            results[name] = {'params': params, 'corpus_hash': corpus_hash, 'timings': timings, 'stats': stats}
+            baseline_result = baseline['scenarios'].get(name) if baseline else None
+            regressions += [f"{name}/{stage}" for stage in
+                            report_scenario(name, results[name], baseline_result, args.threshold, args.min_time)]
+
+    if args.save:
+        # 只更新本次运行的场景，其他场景保留原有基准
+        saved = load_baseline(args.baseline) or {'version': BENCH_VERSION, 'scenarios': {}}
+        saved['python'] = platform.python_version()
+        saved['machine'] = platform.machine()
+        saved['scenarios'].update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(saved, f, ensure_ascii=False, indent=2)
+        print(f"\n{GREEN}基准已保存到 {args.baseline}{RESET}")
+        return 0
+
+    if baseline is None:
+        print(f"\n{GRAY}没有基准数据，使用 --save 保存本次结果作为基准{RESET}")
+        return 0
+    if baseline.get('python') != platform.python_version():
+        print(f"\n{YELLOW}基准使用 Python {baseline.get('python')} 测得，与当前版本不同{RESET}")
+    if regressions:
+        print(f"\n{RED}以下阶段比基准慢 {args.threshold * 100:.0f}% 以上: {', '.join(regressions)}{RESET}")
+        return 1
+    print(f"\n{GREEN}没有发现性能下降{RESET}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
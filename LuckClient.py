@@ -0,0 +1,123 @@
+# 功能解释
+# LuckChecker的轻量客户端，供编辑器插件和git钩子调用
+# 1. 把检查请求发给 Luck.py --serve 启动的检查服务，省去每次启动时解析配置、编译规则的时间
+# 2. 没有服务在运行时，回退到进程内检查，结果相同
+# 3. 命中记录以JSON Lines输出到标准输出，格式与 Luck.py --format jsonl 一致，统计信息写到stderr
+# 4. 检查模式下发现需要替换的位置或不符合命名规则的变量时退出码为1，出错时为2；个别文件无法读取时其余文件照常输出，退出码同样为2
+
+
+import os
+import sys
+import json
+import socket
+import hashlib
+import tempfile
+import argparse
+import contextlib
+
+# 根据配置文件路径生成默认的套接字路径，每个用户、每个配置文件各一个服务
+def default_socket_path(config_file):
+    abs_path = os.path.abspath(config_file)
+    path_hash = hashlib.blake2b(abs_path.encode('utf-8'), digest_size=8).hexdigest()
+    user = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), f"luck-{user}-{path_hash}.sock")
+
+# 把请求发送给检查服务
+def send_request(socket_path, request):
+    """没有服务在运行时返回None；已连上服务后出现的错误照常抛出，避免同一个修改请求被执行两次"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise OSError("检查服务没有返回结果")
+    return json.loads(line)
+
+# 没有服务时在当前进程内检查
+def check_in_process(config_file, request, cache_dir=None):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import Luck
+
+    # 配置错误信息写到stderr，保证标准输出中只有记录
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            service = Luck.CheckService(config_file, cache_dir)
+        except ValueError as e:
+            return {'ok': False, 'error': str(e)}
+        return service.handle(request)
+
+# 主函数
+def main():
+    parser = argparse.ArgumentParser(description='幸运检查工具客户端')
+    parser.add_argument('paths', nargs='*',
+                      help='需要检查的文件')
+    parser.add_argument('-y', '--yes', dest='apply_changes', action='store_true',
+                      help='实际执行文件修改')
+    parser.add_argument('-i', '--indicator', dest='check_pointer', action='store_true',
+                      help='检查指针定义')
+    parser.add_argument('-c', '--config', default='config.ini',
+                      help='指定配置文件路径，默认为config.ini')
+    parser.add_argument('--socket', default=None, dest='socket_path',
+                      help='检查服务的套接字路径，默认根据配置文件路径生成')
+    parser.add_argument('--stdin', default=None, dest='stdin_name', metavar='NAME',
+                      help='从标准输入读取编辑器缓冲区内容进行检查，NAME为记录中显示的文件名')
+    parser.add_argument('--max-hits-per-file', type=int, default=None, dest='max_hits',
+                      help='每个文件最多输出的替换数量')
+    parser.add_argument('--cache', nargs='?', const='.luckcache', default=None, dest='cache_dir',
+                      help='回退到进程内检查时使用的配置缓存目录')
+    args = parser.parse_args()
+
+    # 服务的工作目录与客户端不同，发送绝对路径，输出时再换回命令行上给出的路径
+    display_paths = {os.path.abspath(path): path for path in args.paths}
+    if args.stdin_name is not None:
+        request = {'op': 'check_text', 'path': args.stdin_name, 'text': sys.stdin.read(), 'pointers': args.check_pointer, 'max_hits': args.max_hits}
+    elif not args.paths:
+        parser.error("需要指定文件或 --stdin")
+    elif args.apply_changes:
+        request = {'op': 'apply', 'paths': list(display_paths)}
+    else:
+        request = {'op': 'check', 'paths': list(display_paths), 'pointers': args.check_pointer, 'max_hits': args.max_hits}
+
+    try:
+        response = send_request(args.socket_path or default_socket_path(args.config), request)
+        source = '检查服务'
+        if response is None:
+            response = check_in_process(args.config, request, args.cache_dir)
+            source = '进程内'
+    except (OSError, ValueError) as e:
+        response = {'ok': False, 'error': str(e)}
+
+    if not response.get('ok'):
+        print(f"错误: {response.get('error')}", file=sys.stderr)
+        return 2
+
+    write = sys.stdout.write
+    for record in response['hits']:
+        record['file'] = display_paths.get(record['file'], record['file'])
+        write(json.dumps(record, ensure_ascii=False))
+        write('\n')
+    sys.stdout.flush()
+
+    # 无法读取或解码的文件逐个说明，不影响其余文件的结果
+    errors = response.get('errors', [])
+    for error in errors:
+        print(f"跳过文件 {display_paths.get(error['file'], error['file'])}: {error['error']}", file=sys.stderr)
+
+    action = '已替换' if args.apply_changes else '需要替换'
+    print(f"总发现{response['total']}处{action}，{response['files']} 个文件（{source}）", file=sys.stderr)
+    if errors:
+        return 2
+    violations = response['total'] or any(record['category'] == 'check' for record in response['hits'])
+    return 1 if violations and not args.apply_changes else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
 1 MdnsDiscoveredDevice( const MdnsDiscoveredDevice & )            = delete;
 2 MSG_OBJECT_ACTIVATED *pMsg = new ( pData ) MSG_OBJECT_ACTIVATED( length, id, static_cast< HM_UINT32 >( data.size() ) );
 3 MSG_OBJECT_LIST *pMsg = new ( pData ) MSG_OBJECT_LIST;
+4 bool * const m_pReady = &ready, *const m_bDone = nullptr;